@@ -1,27 +1,43 @@
+import time  # To simulate streaming behavior
+startup_time = time.perf_counter()  # Time-to-prompt is measured from here
+
 import os
 import contextlib
 import sys
-import cohere
 import json
-import requests
+import re
+import glob
+import asyncio
+import pickle
 import wave
-import time  # To simulate streaming behavior
 import subprocess
 import threading
+import queue
+import heapq
+import random
+import math
+import mmap
+import struct
+import bisect
+import hashlib
+import sqlite3
+from collections import deque, Counter
+from array import array
+import tempfile
+import shutil
+from concurrent.futures import ThreadPoolExecutor, CancelledError, wait, as_completed, FIRST_COMPLETED
 from colorama import Fore, Style, init
-from difflib import SequenceMatcher  # For response similarity check
 # from TTS.api import TTS  # For Coqui TTS integration
-
-# Ensure a bot name argument is provided
-if len(sys.argv) < 2:
-    print(Fore.RED + "Error: Please provide the bot name as a command-line argument.")
-    sys.exit(1)
+# cohere and requests are imported where they are first needed, they take longer to import than everything above
 
 # Initialize colorama for Windows compatibility
 init(autoreset=True)
 
-# Get the API key from environment variables
+# Get the API keys from environment variables: COHERE_API_KEYS can hold several, separated by commas
 api_key = os.getenv("COHERE_API_KEY")
+api_keys = [key for key in re.split(r"[,;\s]+", os.getenv("COHERE_API_KEYS", "")) if key]
+if api_key and api_key not in api_keys:
+    api_keys.append(api_key)
 
 # Initialize the Cohere client with the API key
 proxies = {
@@ -29,26 +45,329 @@ proxies = {
     'https': os.getenv('HTTPS_PROXY')
 }
 
+# One pooled HTTP session for the IP check and the TTS server, so connections are reused
+http_session = None
+http_session_lock = threading.Lock()
+
+def get_http_session():
+    """Return the shared requests session, creating it on first use."""
+    global http_session
+    with http_session_lock:
+        if http_session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            http_session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+            http_session.mount("http://", adapter)
+            http_session.mount("https://", adapter)
+    return http_session
+
 # Check the IP address using the proxy at the beginning of the script.
 def check_ip():
+    import requests
     try:
-        response = requests.get("http://ipinfo.io/ip", proxies=proxies)
+        response = get_http_session().get("http://ipinfo.io/ip", proxies=proxies, timeout=15)
         response.raise_for_status()
         print(f"ProxyCheck, Your IP address is: {response.text.strip()}")
+        return True
     except requests.RequestException as e:
         print(f"Error checking IP address: {e}")
-        sys.exit(1)
-        
-check_ip()
-
-# Initialize the Cohere client without proxies
-co = cohere.ClientV2(api_key=api_key)
-
-# Get the bot name from the command-line argument
-assistant_name = sys.argv[1]
-
-# Define the path to the system message file based on the bot name
-system_message_file = f"{assistant_name}_system.txt"
+        return False
+
+# The IP check runs in the background while the bot loads, and the first API call waits for it
+ip_check_done = threading.Event()
+ip_check_passed = True
+
+def run_ip_check():
+    global ip_check_passed
+    ip_check_passed = check_ip()
+    ip_check_done.set()
+
+def skip_ip_check():
+    ip_check_done.set()
+
+# Rate limits per API key, and how failed calls are retried
+# Client-side cap on chat calls per key and minute, 0 for none and to rely on the API's 429 and Retry-After.
+# Set CHATBOT_KEY_CALLS_PER_MINUTE=20 when every key is a trial key, to not even hit their limit.
+KEY_CALLS_PER_MINUTE = int(os.getenv("CHATBOT_KEY_CALLS_PER_MINUTE", "0"))
+KEY_COOLDOWN_SECONDS = 60         # Rest a key this long after a 429 that gives no Retry-After
+BAD_KEY_COOLDOWN_SECONDS = 3600   # Rest a key this long after it is rejected (spent or revoked)
+API_MAX_RETRIES = 4
+# Turns off the SDK's own retries, so failed calls are only retried by the pool, which rotates keys and backs off
+API_REQUEST_OPTIONS = {"max_retries": 0}
+API_BACKOFF_BASE = 1.0            # Seconds, doubled on every retry and jittered
+API_BACKOFF_MAX = 20.0
+API_TIMEOUT_SECONDS = 120
+API_BASE_URL = os.getenv("CO_API_URL")  # Point at another server, e.g. the stub in .benchmark.py
+
+# Hedged requests: a call slower than most recent ones is raced by a duplicate through another key, or
+# through the fallback model when there is only one key. The first answer wins. Costs extra API calls.
+HEDGE_REQUESTS = os.getenv("CHATBOT_HEDGE") == "1"
+HEDGE_PERCENTILE = 0.95           # Hedge once a call is slower than this share of recent calls
+HEDGE_MIN_DELAY_SECONDS = 1.0     # Never hedge sooner than this
+HEDGE_LATENCY_WINDOW = 200        # Recent latencies the percentile is taken over, kept apart for whole replies and for the time to first token of streams
+HEDGE_MIN_SAMPLES = 20            # No hedging of a kind of call until this many of them were timed
+HEDGE_FALLBACK_MODEL = "c4ai-aya-expanse-32b"
+HEDGE_FALLBACK_MAX_TOKENS = 7000  # Its context is 8k tokens, larger requests are duplicated on the same model
+
+class ApiKeyState:
+    """A pooled API key with its client, recent calls and cooldown."""
+
+    def __init__(self, key, client):
+        self.key = key
+        self.label = f"...{key[-4:]}" if key else "default"
+        self.client = client
+        self.cooldown_until = 0.0
+        self.rejected_until = 0.0    # Set with the cooldown when the API rejects the key itself
+        self.in_flight = 0
+        self.recent_calls = deque()  # Start times of the calls in the last minute
+
+    def available_at(self, now):
+        """Return when this key may be used next, now if it is free."""
+        while self.recent_calls and now - self.recent_calls[0] >= 60:
+            self.recent_calls.popleft()
+        ready_at = self.cooldown_until
+        if KEY_CALLS_PER_MINUTE and len(self.recent_calls) >= KEY_CALLS_PER_MINUTE:
+            ready_at = max(ready_at, self.recent_calls[0] + 60)
+        return max(ready_at, now)
+
+class ClientPool:
+    """Spreads chat calls over every API key, respecting rate limits and retrying failures with backoff.
+
+    Offers the chat and chat_stream calls of cohere.ClientV2, so it is used in its place.
+    """
+
+    def __init__(self, keys):
+        import cohere
+        import httpx
+        # One connection pool for all keys
+        self.http_client = httpx.Client(timeout=API_TIMEOUT_SECONDS, limits=httpx.Limits(max_connections=100, max_keepalive_connections=20))
+        client_options = {"base_url": API_BASE_URL} if API_BASE_URL else {}
+        self.keys = [
+            ApiKeyState(key, cohere.ClientV2(api_key=key, httpx_client=self.http_client, **client_options))
+            for key in keys or [None]
+        ]
+        self.condition = threading.Condition()
+
+        # Recent latencies for the hedging delay of each kind of call, and how hedging has paid off.
+        # Whole replies take far longer than a stream's first token, so they are not mixed
+        self.latencies = {kind: deque(maxlen=HEDGE_LATENCY_WINDOW) for kind in ("chat", "chat_stream")}
+        self.hedge_stats = {"calls": 0, "hedged": 0, "hedge_wins": 0, "saved_seconds": 0.0}
+        self.stats_lock = threading.Lock()
+
+    def acquire(self):
+        """Wait for the least busy key that is not cooling down or over its rate limit."""
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                if not self.has_usable_key(now):
+                    raise RuntimeError(f"Every API key was rejected by the API (spent or revoked) and is skipped for {BAD_KEY_COOLDOWN_SECONDS // 60} minutes. Check the keys.")
+                ready = [key_state for key_state in self.keys if key_state.available_at(now) <= now]
+                if ready:
+                    key_state = min(ready, key=lambda k: (k.in_flight, len(k.recent_calls)))
+                    key_state.in_flight += 1
+                    key_state.recent_calls.append(now)
+                    return key_state
+                wait_time = min(key_state.available_at(now) for key_state in self.keys) - now
+                print(Fore.YELLOW + f"All API keys are rate limited, waiting {wait_time:.0f}s..." + Style.RESET_ALL)
+                self.condition.wait(timeout=wait_time)
+
+    def release(self, key_state, error=None):
+        """Return a key to the pool, cooling it down if the API rejected it."""
+        with self.condition:
+            key_state.in_flight -= 1
+            status_code = getattr(error, "status_code", None)
+            if status_code == 429:
+                headers = getattr(error, "headers", None) or {}
+                try:
+                    cooldown = float(headers.get("retry-after", KEY_COOLDOWN_SECONDS))
+                except (TypeError, ValueError):
+                    cooldown = KEY_COOLDOWN_SECONDS
+                key_state.cooldown_until = time.monotonic() + cooldown
+                print(Fore.YELLOW + f"API key {key_state.label} is rate limited, resting it for {cooldown:.0f}s." + Style.RESET_ALL)
+            elif status_code in (401, 402, 403):
+                key_state.cooldown_until = key_state.rejected_until = time.monotonic() + BAD_KEY_COOLDOWN_SECONDS
+                print(Fore.RED + f"API key {key_state.label} was rejected ({status_code}), skipping it for now." + Style.RESET_ALL)
+            self.condition.notify_all()
+
+    def has_usable_key(self, now=None):
+        """Check whether any key has not been rejected recently, so waiting for it can pay off."""
+        now = time.monotonic() if now is None else now
+        return any(key_state.rejected_until <= now for key_state in self.keys)
+
+    def should_retry(self, error, attempt):
+        """Rate limits, server errors and network errors are retried, and rejected keys while another key is usable."""
+        if attempt >= API_MAX_RETRIES:
+            return False
+        status_code = getattr(error, "status_code", None)
+        if status_code in (401, 402, 403):
+            return self.has_usable_key()
+        if status_code is not None:
+            return status_code in (401, 402, 403, 429) or status_code >= 500
+        import httpx
+        return isinstance(error, (httpx.TimeoutException, httpx.TransportError))
+
+    def backoff(self, error, attempt):
+        """Sleep before a retry. A rate-limited or rejected key is swapped for another one instead."""
+        if getattr(error, "status_code", None) in (401, 402, 403, 429) and len(self.keys) > 1:
+            return
+        delay = random.uniform(0, min(API_BACKOFF_MAX, API_BACKOFF_BASE * 2 ** attempt))
+        print(Fore.YELLOW + f"API call failed ({error}), retrying in {delay:.1f}s..." + Style.RESET_ALL)
+        time.sleep(delay)
+
+    def chat(self, **kwargs):
+        return self.hedged("chat", self.send_chat, kwargs)
+
+    def chat_stream(self, **kwargs):
+        first_event, stream = self.hedged("chat_stream", self.open_stream, kwargs)
+        if first_event is not None:
+            yield first_event
+            yield from stream
+
+    def open_stream(self, kwargs):
+        """Start a stream and wait for its first event, so hedges race on the time to first token."""
+        stream = self.send_chat_stream(kwargs)
+        return next(stream, None), stream
+
+    def hedge_delay(self, kind):
+        """Seconds to wait before hedging a call of this kind, None while there are too few samples or hedging is off."""
+        with self.stats_lock:
+            latencies = self.latencies[kind]
+            if not HEDGE_REQUESTS or len(latencies) < HEDGE_MIN_SAMPLES:
+                return None
+            samples = sorted(latencies)
+        return max(HEDGE_MIN_DELAY_SECONDS, samples[min(len(samples) - 1, int(HEDGE_PERCENTILE * len(samples)))])
+
+    def hedge_kwargs(self, kwargs):
+        """The duplicate's arguments: the same request, on the fallback model when there is no second key to take it."""
+        if len(self.keys) > 1 or not HEDGE_FALLBACK_MODEL:
+            return kwargs  # acquire() gives it the least busy key, which is not the one the first call holds
+        if sum(estimate_tokens(msg) for msg in kwargs.get("messages", [])) > HEDGE_FALLBACK_MAX_TOKENS:
+            return kwargs
+        return {**kwargs, "model": HEDGE_FALLBACK_MODEL}
+
+    def hedged(self, kind, send, kwargs):
+        """Run send(kwargs), racing it with a duplicate if it takes longer than the hedging delay of this kind of call."""
+        delay = self.hedge_delay(kind)
+        start_time = time.perf_counter()
+        if delay is None:
+            result = send(kwargs)
+            self.record_latency(kind, time.perf_counter() - start_time, hedged=False)
+            return result
+
+        outcomes = queue.Queue()
+
+        def run(name, call_kwargs):
+            try:
+                outcomes.put((name, send(call_kwargs), None, time.perf_counter()))
+            except Exception as e:
+                outcomes.put((name, None, e, time.perf_counter()))
+
+        threading.Thread(target=run, args=("first", kwargs), daemon=True).start()
+        hedge_sent = False
+        loser_running = False
+        try:
+            name, result, error, finished_at = outcomes.get(timeout=delay)
+        except queue.Empty:
+            print(Fore.YELLOW + f"API call is taking longer than {delay:.1f}s, sending a hedged duplicate." + Style.RESET_ALL)
+            threading.Thread(target=run, args=("hedge", self.hedge_kwargs(kwargs)), daemon=True).start()
+            hedge_sent = True
+            name, result, error, finished_at = outcomes.get()
+            loser_running = True
+            if error is not None:  # The first to finish failed, the other one may still succeed
+                name, result, error, finished_at = outcomes.get()
+                loser_running = False
+
+        if loser_running:
+            # The loser is dropped when it finishes, a stream is closed at its first event
+            threading.Thread(target=self.discard_loser, args=(outcomes, name, finished_at), daemon=True).start()
+        self.record_latency(kind, finished_at - start_time, hedged=hedge_sent, hedge_won=name == "hedge" and error is None)
+        if error is not None:
+            raise error
+        return result
+
+    def discard_loser(self, outcomes, winner, won_at):
+        """Wait for the losing call of a hedged pair, close it, and count how much time the winner saved."""
+        name, result, error, finished_at = outcomes.get()
+        if isinstance(result, tuple) and hasattr(result[1], "close"):
+            result[1].close()  # An open stream, stop generating tokens nobody reads
+        if winner == "hedge" and error is None:
+            with self.stats_lock:
+                self.hedge_stats["saved_seconds"] += finished_at - won_at
+
+    def record_latency(self, kind, seconds, hedged, hedge_won=False):
+        with self.stats_lock:
+            self.latencies[kind].append(seconds)
+            self.hedge_stats["calls"] += 1
+            self.hedge_stats["hedged"] += hedged
+            self.hedge_stats["hedge_wins"] += hedge_won
+
+    def format_hedge_stats(self):
+        """Hedge rate and latency saved, for the stats command."""
+        with self.stats_lock:
+            stats = dict(self.hedge_stats)
+        rate = stats["hedged"] / stats["calls"] if stats["calls"] else 0.0
+        return (f"Hedged {stats['hedged']} of {stats['calls']} calls ({rate:.0%}), the duplicate won {stats['hedge_wins']} times "
+                f"and saved {stats['saved_seconds']:.1f}s in total. Hedging is {'on' if HEDGE_REQUESTS else 'off'}.")
+
+    def send_chat(self, kwargs):
+        for attempt in range(API_MAX_RETRIES + 1):
+            key_state = self.acquire()
+            try:
+                response = key_state.client.chat(**kwargs, request_options=API_REQUEST_OPTIONS)
+            except Exception as e:
+                self.release(key_state, e)
+                if not self.should_retry(e, attempt):
+                    raise
+                self.backoff(e, attempt)
+                continue
+            self.release(key_state)
+            return response
+
+    def send_chat_stream(self, kwargs):
+        # A stream can only be retried until its first event, after that the reply is partly shown
+        for attempt in range(API_MAX_RETRIES + 1):
+            key_state = self.acquire()
+            started = False
+            error = None
+            try:
+                for event in key_state.client.chat_stream(**kwargs, request_options=API_REQUEST_OPTIONS):
+                    started = True
+                    yield event
+            except Exception as e:
+                error = e
+            finally:
+                self.release(key_state, error)
+            if error is None:
+                return
+            if started or not self.should_retry(error, attempt):
+                raise error
+            self.backoff(error, attempt)
+
+# The client pool, created on first use and shared by every chat session
+co = None
+client_lock = threading.Lock()
+
+def get_client():
+    """Return the client pool, importing cohere and waiting for the IP check the first time."""
+    global co
+    if co is None:
+        ip_check_done.wait()
+        if not ip_check_passed:
+            print(Fore.RED + "Error: The proxy check failed, not sending anything to the API.")
+            sys.exit(1)
+        with client_lock:
+            if co is None:
+                # Initialize the Cohere clients without proxies
+                co = ClientPool(api_keys)
+    return co
+
+def preload_client_modules():
+    """Import cohere in the background so the first message does not wait for it."""
+    threading.Thread(target=lambda: __import__("cohere"), daemon=True).start()
+
+# Warn when getting to the first prompt takes longer than this
+STARTUP_TARGET_SECONDS = 1.0
 
 # Define shared parameters for Cohere chat API
 params = {
@@ -60,114 +379,1494 @@ params = {
     "safety_mode": "NONE"      # Set safety mode to NONE
 }
 
-# Declare the global 'keywords' variable at the top of the script
-keywords = {}
+# Only match keys on whole words, so "city" no longer fires on "velocity"
+whole_word_keywords = False
+
+# Ranked lore retrieval (BM25 over each entry's title, keys and content), so paraphrases find lore too
+LORE_TOP_K = 3                # Ranked entries offered per message, on top of exact key matches
+LORE_TOKEN_BUDGET = 1500      # Estimated tokens of ranked entries offered per message
+LORE_MIN_SCORE = 6.0          # Weaker hits are noise, roughly one rare shared word
+LORE_POSTINGS_LIMIT = 2000    # Highest-weighted entries scored per query word, bounding the cost of common words
+LORE_COMMON_WORD_FRACTION = 0.1  # Words in more entries than this ("the", "and") are left out of the index,
+LORE_COMMON_WORD_MIN = 50        # unless they are in fewer entries than this
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Reference material injected per turn, best first: exact key matches, then ranked entries, newest mentions first
+KEYWORD_INJECTION_TOKEN_BUDGET = 2000  # Estimated tokens per turn, though at least one entry is always injected
+KEYWORD_PENDING_TURNS = 10             # Mentions still queued after this many turns are dropped
+REFERENCE_PREFIX = "[!!AI_IGNORE_FORMAT!!\nReference Material:\n - "
+
+# Rewrite the snapshot and start a fresh journal after this many journal records
+JOURNAL_COMPACT_EVERY = 200
+
+# Token budget for each request: the pinned system prompt, the rolling summary and the newest turns
+# Tokens are estimated from the character count, which is close enough for English text
+CONTEXT_TOKEN_BUDGET = 32000
+CHARS_PER_TOKEN = 4
+MESSAGE_TOKEN_OVERHEAD = 4  # Role and separators added around every message
+# Once the window is full, evict at least this many tokens at once so the summary is not updated every turn
+SUMMARY_BATCH_TOKENS = 4000
+SUMMARY_MAX_WORDS = 400
+
+# Repetition-loop detection: each reply is compared with the last few using MinHash sketches of its word shingles
+REPETITION_THRESHOLD = 0.5   # Estimated similarity (0-1) above which a reply counts as a repeat
+REPETITION_WINDOW = 5        # Number of earlier replies to compare against
+REPETITION_RETRIES = 1       # Regenerations before a repeating reply is accepted anyway
+
+# Retries request several candidates at once, with varied temperature and seed, to swipe between
+RETRY_CANDIDATES = 3          # 1 streams a single retry instead
+RETRY_TEMPERATURE_STEP = 0.15 # Candidates alternate above and below the configured temperature by this much
+CANDIDATE_WORKERS = 8         # Threads generating candidates, shared by every session
+candidate_executor = ThreadPoolExecutor(max_workers=CANDIDATE_WORKERS, thread_name_prefix="candidate")
+SHINGLE_WORDS = 3            # Words per shingle
+SKETCH_SIZE = 128            # Smallest shingle hashes kept per reply
+ANTI_REPETITION_INSTRUCTION = "(OOC: Your last reply repeated your earlier replies. Write a fresh reply that moves the roleplay forward with new wording, actions and details. Do not reuse sentences from earlier replies.)"
 
-# Global list to hold pending keywords
-pending_keywords = []
-
-# Load the system configuration from a plaintext file
-try:
-    system_message = ""
-    ai_greeting = ""
-    keys_files = []
+# Ensure the history directory exists
+history_dir = os.path.join(os.getcwd(), "history")
+os.makedirs(history_dir, exist_ok=True)
 
-    with open(system_message_file, 'r') as file:
-        lines = file.readlines()
-        current_section = "system_message"  # Default to system message section
+# Parsed personas and compiled keyword indexes, reused while their files are unchanged
+cache_dir = os.path.join(os.getcwd(), "cache")
+PERSONA_CACHE_VERSION = 9
+
+# Loaded personas are checked for edited system and keys files this often, and reloaded without a restart
+RELOAD_POLL_SECONDS = 2.0
+# Keys added or changed by a reload go into a small second automaton instead of recompiling every key,
+# until there are more of them than this count or share of all entries
+KEYWORD_OVERLAY_MAX = 500
+KEYWORD_OVERLAY_FRACTION = 0.05
+# The ranking index is rebuilt in the background once edits have settled for this long, so a burst of saves costs one rebuild
+LORE_REBUILD_DELAY_SECONDS = 5.0
+# That rebuild also copies the entry contents to a fresh store once reloads have left the old one mostly
+# replaced text: larger than this many times the contents in use, and by at least LORE_STORE_COMPACT_MIN_BYTES
+LORE_STORE_COMPACT_RATIO = 2.0
+LORE_STORE_COMPACT_MIN_BYTES = 1 << 20
+
+# Server mode keeps the live files of every session here, the interactive chat keeps them in cwd
+sessions_dir = os.path.join(os.getcwd(), "sessions")
+
+# Full-text index of every conversation, current and backed up, brought up to date before each search
+archive_file = os.path.join(history_dir, "archive.sqlite3")
+ARCHIVE_SEARCH_RESULTS = 10
+
+def replace_file(path, text):
+    """Write text to a temporary file and atomically swap it in, so a crash never leaves a half-written file."""
+    temp_path = path + ".tmp"
+    with open(temp_path, 'w') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+# Per-stage timing spans of every turn, kept in a ring buffer for the 'stats' command
+METRICS_RING_SIZE = 2000
+METRICS_JSONL_FILE = os.getenv("CHATBOT_METRICS_JSONL")      # Append every span to this file as a JSON line
+METRICS_PROMETHEUS_FILE = os.getenv("CHATBOT_METRICS_PROM")  # Rewrite this Prometheus text-format file after every turn
+
+class SpanRecorder:
+    """Records how long each stage of a turn takes, along with request and response sizes."""
+
+    def __init__(self):
+        self.spans = deque(maxlen=METRICS_RING_SIZE)  # (stage, seconds, attributes)
+        self.totals = {}    # stage -> [count, seconds] since start, for the Prometheus counters
+        self.pending = []   # Spans not written to the JSONL file yet
+        self.lock = threading.Lock()
+        self.export_lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, stage, **attributes):
+        """Time the block, which can add attributes such as sizes to the yielded dict."""
+        start = time.perf_counter()
+        try:
+            yield attributes
+        except BaseException as e:
+            attributes["error"] = type(e).__name__
+            raise
+        finally:
+            self.record(stage, time.perf_counter() - start, attributes)
+
+    def record(self, stage, seconds, attributes=None):
+        with self.lock:
+            self.spans.append((stage, seconds, attributes))
+            totals = self.totals.setdefault(stage, [0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+            if METRICS_JSONL_FILE:
+                self.pending.append({"time": time.time(), "stage": stage, "seconds": seconds, **(attributes or {})})
+
+    def stats(self):
+        """Count, p50, p95, p99 and max in seconds for every stage in the ring buffer."""
+        with self.lock:
+            spans = list(self.spans)
+        samples_by_stage = {}
+        for stage, seconds, _ in spans:
+            samples_by_stage.setdefault(stage, []).append(seconds)
+
+        stats = {}
+        for stage, samples in samples_by_stage.items():
+            samples.sort()
+            stats[stage] = {"count": len(samples), "max": samples[-1]}
+            for name, fraction in (("p50", 0.50), ("p95", 0.95), ("p99", 0.99)):
+                stats[stage][name] = samples[min(len(samples) - 1, int(fraction * len(samples)))]
+        return stats
+
+    def format_stats(self):
+        """The stats as a table in milliseconds, for the console."""
+        stats = self.stats()
+        if not stats:
+            return "No turns recorded yet."
+        lines = [f"{'stage':<16}{'count':>7}{'p50 ms':>11}{'p95 ms':>11}{'p99 ms':>11}{'max ms':>11}"]
+        for stage, stage_stats in stats.items():
+            lines.append(
+                f"{stage:<16}{stage_stats['count']:>7}"
+                + "".join(f"{stage_stats[name] * 1000:>11.1f}" for name in ("p50", "p95", "p99", "max"))
+            )
+        return "\n".join(lines)
+
+    def export(self):
+        """Write pending spans to the JSONL file and refresh the Prometheus file, when they are enabled.
+
+        Errors are printed rather than raised, so a turn never fails over its metrics.
+        """
+        if not METRICS_JSONL_FILE and not METRICS_PROMETHEUS_FILE:
+            return
+        # One export at a time, concurrent turns would otherwise race on the same temporary file
+        with self.export_lock:
+            try:
+                self.write_exports()
+            except Exception as e:
+                print(Fore.YELLOW + f"Could not export metrics: {e}" + Style.RESET_ALL)
+
+    def write_exports(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+            totals = {stage: list(values) for stage, values in self.totals.items()}
+
+        if METRICS_JSONL_FILE and pending:
+            with open(METRICS_JSONL_FILE, 'a') as f:
+                f.write("".join(json.dumps(span) + "\n" for span in pending))
+
+        if METRICS_PROMETHEUS_FILE:
+            lines = [
+                "# HELP chatbot_stage_seconds Time spent in each stage of a chat turn.",
+                "# TYPE chatbot_stage_seconds summary",
+            ]
+            for stage, stage_stats in self.stats().items():
+                for name, quantile in (("p50", "0.5"), ("p95", "0.95"), ("p99", "0.99")):
+                    lines.append(f'chatbot_stage_seconds{{stage="{stage}",quantile="{quantile}"}} {stage_stats[name]:.6f}')
+            for stage, (count, seconds) in totals.items():
+                lines.append(f'chatbot_stage_seconds_sum{{stage="{stage}"}} {seconds:.6f}')
+                lines.append(f'chatbot_stage_seconds_count{{stage="{stage}"}} {count}')
+            replace_file(METRICS_PROMETHEUS_FILE, "\n".join(lines) + "\n")
+
+# Shared by every session in the process
+metrics = SpanRecorder()
+
+def usage_tokens(usage):
+    """Billed input and output tokens from a chat response's usage, None when the API did not report them."""
+    tokens = getattr(usage, "tokens", None)
+    input_tokens = getattr(tokens, "input_tokens", None)
+    output_tokens = getattr(tokens, "output_tokens", None)
+    return (int(input_tokens) if input_tokens is not None else None,
+            int(output_tokens) if output_tokens is not None else None)
+
+def read_journal(journal_file, generation):
+    """Return the records written after a snapshot of this generation, and whether the last line was torn.
+
+    The records are None when there is no journal or it was started on top of another snapshot.
+    """
+    if not os.path.exists(journal_file):
+        return None, False
+    with open(journal_file, 'r') as f:
+        lines = f.readlines()
+    records = []
+    torn_journal = False
     for line in lines:
-        stripped_line = line.strip()
-        if not stripped_line or stripped_line.startswith("#"):  # Ignore empty lines or comments
-            continue
-        if stripped_line == "ai_greeting:":
-            current_section = "ai_greeting"
-        elif stripped_line == "keys_files:":
-            current_section = "keys_files"
-        elif current_section == "ai_greeting":
-            if ai_greeting:
-                ai_greeting += " " + stripped_line
-            else:
-                ai_greeting = stripped_line
-        elif current_section == "keys_files":
-            keys_files.append(stripped_line)
+        try:
+            records.append(json.loads(line))
+        except json.JSONDecodeError:
+            torn_journal = True  # A crash in the middle of an append, drop the partial record
+            break
+    if records and records[0].get("op") == "base" and records[0].get("generation") == generation:
+        return records[1:], torn_journal
+    return None, torn_journal
+
+def replay_journal(messages, records):
+    """Apply journal records to the snapshot's messages and return the last rolling summary they recorded, if any."""
+    summary = None
+    for record in records:
+        if record["op"] == "append":
+            messages.append(record["message"])
+        elif record["op"] == "truncate":
+            del messages[record["length"]:]
+        elif record["op"] == "summary":
+            summary = record["summary"]
+    return summary
+
+def new_summary():
+    """The rolling summary of a conversation nothing has been folded into yet."""
+    return {"text": "", "window_start": 1}
+
+def estimate_tokens(message):
+    """Estimate the number of tokens a message adds to a request."""
+    return len(message.get("content") or "") // CHARS_PER_TOKEN + MESSAGE_TOKEN_OVERHEAD
+
+WORD_PATTERN = re.compile(r"\w+")
+
+def reply_sketch(text):
+    """Bottom-k MinHash sketch of a reply's word shingles, built in time linear in its length."""
+    words = WORD_PATTERN.findall(text.lower())
+    if len(words) < SHINGLE_WORDS:
+        shingles = {hash(" ".join(words))} if words else set()
+    else:
+        shingles = {hash(" ".join(words[i:i + SHINGLE_WORDS])) for i in range(len(words) - SHINGLE_WORDS + 1)}
+    return frozenset(heapq.nsmallest(SKETCH_SIZE, shingles))
+
+def sketch_similarity(sketch_a, sketch_b):
+    """Estimate the Jaccard similarity of two replies' shingles from their sketches."""
+    if not sketch_a or not sketch_b:
+        return 0.0
+    union_sketch = heapq.nsmallest(SKETCH_SIZE, sketch_a | sketch_b)
+    shared = sum(1 for shingle in union_sketch if shingle in sketch_a and shingle in sketch_b)
+    return shared / len(union_sketch)
+
+def is_persona_message(message):
+    """Check whether a message is the persona system prompt rather than injected reference material."""
+    return message.get("role") == "system" and not message.get("content", "").startswith("[!!AI_IGNORE_FORMAT!!")
+
+def keyword_label(entry):
+    """The label an entry is queued and injected under: its first key, lowercased."""
+    return entry.key[0].strip().lower() if entry.key else ''
+
+# Multi-pattern matcher over every keyword key (Aho-Corasick automaton)
+# Built once at load time so each user message is scanned in a single pass,
+# instead of testing every key of every entry against the input.
+class KeywordAutomaton:
+    def __init__(self, entries):
+        """Compile the keys of a {title: LoreEntry} dict."""
+        self.titles = list(entries)
+        self.goto = {}                  # (state << 21) | ord(char) -> next state
+        self.fail = array('l', [0])     # Failure link per state
+        self.dict_link = array('l', [0])  # Nearest suffix state that ends a pattern
+        self.depth = array('l', [0])    # Length of the key spelled by each state
+        self.outputs = {}               # state -> index of the first title with that exact key
+        self.more_outputs = {}          # state -> [further titles sharing the same key]
+        children = [[]]                 # Only needed while building, dropped afterwards
+
+        for title_index, title in enumerate(self.titles):
+            for key in entries[title].key:
+                key = key.strip().lower()
+                if not key:  # An empty key would match every message
+                    continue
+                state = 0
+                for char in key:
+                    edge = (state << 21) | ord(char)
+                    next_state = self.goto.get(edge)
+                    if next_state is None:
+                        next_state = len(self.fail)
+                        self.goto[edge] = next_state
+                        self.fail.append(0)
+                        self.dict_link.append(0)
+                        self.depth.append(self.depth[state] + 1)
+                        children.append([])
+                        children[state].append(char)
+                    state = next_state
+                if state not in self.outputs:
+                    self.outputs[state] = title_index
+                elif self.outputs[state] != title_index:
+                    self.more_outputs.setdefault(state, []).append(title_index)
+
+        # Breadth-first pass to compute failure and dictionary links
+        queue = [self.goto[(0 << 21) | ord(char)] for char in children[0]]
+        head = 0
+        while head < len(queue):
+            state = queue[head]
+            head += 1
+            for char in children[state]:
+                code = ord(char)
+                child = self.goto[(state << 21) | code]
+                fallback = self.fail[state]
+                while fallback and ((fallback << 21) | code) not in self.goto:
+                    fallback = self.fail[fallback]
+                target = self.goto.get((fallback << 21) | code, 0)
+                self.fail[child] = target
+                self.dict_link[child] = target if target in self.outputs else self.dict_link[target]
+                queue.append(child)
+
+    @classmethod
+    def from_state(cls, state):
+        """Rebuild an automaton from its attributes, as stored in the persona cache."""
+        automaton = cls.__new__(cls)
+        automaton.__dict__.update(state)
+        return automaton
+
+    def search(self, text, whole_word=False):
+        """Return the indexes of every title with a key in text, in load order."""
+        text = text.lower()
+        goto = self.goto
+        fail = self.fail
+        dict_link = self.dict_link
+        outputs = self.outputs
+        more_outputs = self.more_outputs
+        found = set()
+        state = 0
+        for position, char in enumerate(text):
+            code = ord(char)
+            while True:
+                next_state = goto.get((state << 21) | code)
+                if next_state is not None:
+                    state = next_state
+                    break
+                if not state:
+                    break
+                state = fail[state]
+
+            match_state = state if state in outputs else dict_link[state]
+            while match_state:
+                if not whole_word or _is_word_bounded(text, position - self.depth[match_state] + 1, position + 1):
+                    found.add(outputs[match_state])
+                    if match_state in more_outputs:
+                        found.update(more_outputs[match_state])
+                match_state = dict_link[match_state]
+        return sorted(found)
+
+def _is_word_bounded(text, start, end):
+    """Check that text[start:end] is not glued to letters or digits on either side."""
+    if start > 0 and (text[start - 1].isalnum() or text[start - 1] == '_'):
+        return False
+    if end < len(text) and (text[end].isalnum() or text[end] == '_'):
+        return False
+    return True
+
+# Ranked retrieval over the lore entries, stored in a flat file that is memory-mapped on load
+# Layout after the header: sorted term hashes, posting start per term, then the entry id and
+# precomputed BM25 term weight of every posting, each term's postings sorted by weight.
+LORE_INDEX_MAGIC = b"LORE"
+LORE_INDEX_VERSION = 1
+LORE_INDEX_HEADER = struct.Struct("<4sIqIIQ")  # magic, version, build id, entries, terms, postings
+POSTING_RECORD = struct.Struct("<qII")  # Term hash, entry id and term frequency, as spilled while building
+LORE_BUILD_BUCKETS = 256                # Term hash ranges sorted one at a time while building, a power of two
+LORE_BUILD_SPILL_POSTINGS = 1000000     # Postings buffered (16 bytes each) before they are spilled to disk
+
+def term_hash(term):
+    """Stable 64-bit hash of a word, the same in every process unlike hash()."""
+    return int.from_bytes(hashlib.blake2b(term.encode('utf-8'), digest_size=8).digest(), 'little', signed=True)
+
+class LoreIndex:
+    def __init__(self, buffer, source=None, titles=None):
+        """Read an index from a bytes-like buffer without copying it."""
+        self.source = source  # Keeps the mmap and file open for as long as the index is used
+        self.titles = titles  # Title of every entry id, in the order the index was built from
+        view = memoryview(buffer)
+        magic, version, self.build_id, self.entry_count, term_count, posting_count = LORE_INDEX_HEADER.unpack_from(view)
+        if magic != LORE_INDEX_MAGIC or version != LORE_INDEX_VERSION:
+            raise ValueError("not a lore index of this version")
+        offset = LORE_INDEX_HEADER.size
+        self.term_hashes = view[offset:offset + 8 * term_count].cast('q')
+        offset += 8 * term_count
+        self.posting_starts = view[offset:offset + 8 * (term_count + 1)].cast('Q')
+        offset += 8 * (term_count + 1)
+        self.posting_entries = view[offset:offset + 4 * posting_count].cast('I')
+        offset += 4 * posting_count
+        self.posting_weights = view[offset:offset + 4 * posting_count].cast('f')
+
+    @staticmethod
+    def build(entries, build_id, path):
+        """Index a {title: LoreEntry} dict into a new file at path.
+
+        Entries are read one at a time. Their postings are split into LORE_BUILD_BUCKETS ranges of term hashes,
+        spilled to a temporary file every LORE_BUILD_SPILL_POSTINGS, and sorted one range at a time,
+        so memory does not grow with the lore size.
+        """
+        lengths = array('I')  # Words per entry
+        hashes = {}           # Word -> term hash, the vocabulary is far smaller than the postings
+        buckets = [bytearray() for _ in range(LORE_BUILD_BUCKETS)]
+        spilled = [[] for _ in range(LORE_BUILD_BUCKETS)]  # (offset, size) of every part of a bucket in the spill file
+        buffered = 0
+        shift = 64 - (LORE_BUILD_BUCKETS.bit_length() - 1)
+        with tempfile.TemporaryFile() as spill_file, tempfile.TemporaryFile() as entries_file, tempfile.TemporaryFile() as weights_file:
+            for entry_id, (title, entry) in enumerate(entries.items()):
+                words = WORD_PATTERN.findall(" ".join([title, *entry.key, entry.content]).lower())
+                lengths.append(len(words))
+                counts = Counter(words)
+                for word, count in counts.items():
+                    hashed = hashes.get(word)
+                    if hashed is None:
+                        hashed = hashes[word] = term_hash(word)
+                    # The top bits pick the bucket, offset so buckets follow the signed hash order
+                    buckets[(hashed >> shift) + LORE_BUILD_BUCKETS // 2] += POSTING_RECORD.pack(hashed, entry_id, count)
+                buffered += len(counts)
+                if buffered >= LORE_BUILD_SPILL_POSTINGS:
+                    for bucket, data in enumerate(buckets):
+                        spilled[bucket].append((spill_file.tell(), len(data)))
+                        spill_file.write(data)
+                        data.clear()
+                    buffered = 0
+            hashes = None
+
+            average_length = sum(lengths) / len(lengths) if lengths else 1.0
+            length_norms = array('f', (BM25_K1 * (1 - BM25_B + BM25_B * length / average_length) for length in lengths))
+            # Common words barely affect the ranking but would make up most of the postings
+            max_frequency = max(LORE_COMMON_WORD_MIN, int(LORE_COMMON_WORD_FRACTION * len(lengths)))
+
+            term_hashes = array('q')
+            posting_starts = array('Q', [0])
+            posting_count = 0
+            for bucket, data in enumerate(buckets):
+                for offset, size in spilled[bucket]:
+                    spill_file.seek(offset)
+                    data += spill_file.read(size)
+                postings = sorted(POSTING_RECORD.iter_unpack(data))
+                buckets[bucket] = None
+                start = 0
+                while start < len(postings):
+                    hashed = postings[start][0]
+                    end = start + 1
+                    while end < len(postings) and postings[end][0] == hashed:
+                        end += 1
+                    if end - start <= max_frequency:
+                        # Everything but the word's idf is known now, so queries only multiply and add
+                        weighted = sorted(
+                            ((count * (BM25_K1 + 1) / (count + length_norms[entry_id]), entry_id) for _, entry_id, count in postings[start:end]),
+                            reverse=True,
+                        )
+                        term_hashes.append(hashed)
+                        entries_file.write(array('I', (entry_id for _, entry_id in weighted)).tobytes())
+                        weights_file.write(array('f', (weight for weight, _ in weighted)).tobytes())
+                        posting_count += len(weighted)
+                        posting_starts.append(posting_count)
+                    start = end
+
+            with open(path, 'wb') as f:
+                f.write(LORE_INDEX_HEADER.pack(LORE_INDEX_MAGIC, LORE_INDEX_VERSION, build_id, len(lengths), len(term_hashes), posting_count))
+                f.write(term_hashes.tobytes())
+                f.write(posting_starts.tobytes())
+                for section in (entries_file, weights_file):
+                    section.seek(0)
+                    shutil.copyfileobj(section, f)
+
+    @classmethod
+    def open(cls, path, titles=None):
+        """Memory-map an index file, so loading costs nothing until it is queried."""
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(mapped, mapped, titles)
+
+    def search(self, text, limit):
+        """Return up to limit (score, entry id) pairs for the entries most relevant to text, best first."""
+        term_hashes = self.term_hashes
+        scores = {}
+        for word in set(WORD_PATTERN.findall(text.lower())):
+            hashed = term_hash(word)
+            position = bisect.bisect_left(term_hashes, hashed)
+            if position == len(term_hashes) or term_hashes[position] != hashed:
+                continue
+            start, end = self.posting_starts[position], self.posting_starts[position + 1]
+            frequency = end - start
+            idf = math.log(1 + (self.entry_count - frequency + 0.5) / (frequency + 0.5))
+            end = min(end, start + LORE_POSTINGS_LIMIT)
+            for entry_id, weight in zip(self.posting_entries[start:end], self.posting_weights[start:end]):
+                scores[entry_id] = scores.get(entry_id, 0.0) + idf * weight
+        return [(score, entry_id) for entry_id, score in heapq.nlargest(limit, scores.items(), key=lambda item: item[1])]
+
+@contextlib.contextmanager
+def locked_file(path):
+    """Hold an exclusive lock on a lock file, so processes sharing the cache directory take turns."""
+    with open(path, 'a+b') as f:
+        if os.name == 'nt':
+            import msvcrt
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
         else:
-            if current_section == "system_message":
-                if system_message:
-                    system_message += " " + stripped_line  # Continue reading system message
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+# Entry contents live in a cache file of UTF-8 text written while the keys files are read,
+# only the offset and length of each one stays in memory and the text is read back through
+# a memory map when an entry is ranked or injected. Stores are never rewritten in place:
+# a full parse starts a new file, a reload appends to the current one. Every process running
+# the persona can append to the same file, so reloads append under a lock on cache/<name>.lock.
+class LoreStore:
+    def __init__(self, path, offsets=None, lengths=None):
+        self.path = path
+        self.lock_path = path.rsplit('.', 2)[0] + ".lock"
+        self.offsets = offsets if offsets is not None else array('Q')  # Byte offset of every stored content
+        self.lengths = lengths if lengths is not None else array('I')  # Byte length of every stored content
+        # Kept open so the store stays readable even if another process removes the file
+        self.file = open(path, 'a+b')
+        self.mapped = None
+        self.lock = threading.RLock()
+
+    @classmethod
+    def create(cls, name):
+        """Start an empty store for a persona, removing its older stores that no process has open."""
+        for old_path in glob.glob(os.path.join(glob.escape(cache_dir), f"{glob.escape(name)}.*.content")):
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass  # Still mapped by a running bot on Windows, left for a later start
+        os.makedirs(cache_dir, exist_ok=True)
+        return cls(os.path.join(cache_dir, f"{name}.{time.time_ns()}.content"))
+
+    @classmethod
+    def open(cls, path, offsets, lengths):
+        """Reopen a store saved in the persona cache, or return None if the file is gone or too short."""
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return None
+        if offsets and offsets[-1] + lengths[-1] > size:  # Rows are appended, so the last one ends furthest
+            return None
+        return cls(path, offsets, lengths)
+
+    def append(self, text):
+        """Write one content to the end of the store and return its row."""
+        data = text.encode('utf-8')
+        with self.lock:
+            self.file.seek(0, os.SEEK_END)
+            self.offsets.append(self.file.tell())
+            self.lengths.append(len(data))
+            self.file.write(data)
+            return len(self.offsets) - 1
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    @contextlib.contextmanager
+    def shared(self):
+        """Append in the block while other processes wait, for a store they may append to as well."""
+        with self.lock, locked_file(self.lock_path):
+            yield
+            self.file.flush()  # Before the lock is released, so the next writer sees the true end of the file
+
+    def read(self, row):
+        """Return the content stored at a row, mapping the file again if it has grown since."""
+        start = self.offsets[row]
+        end = start + self.lengths[row]
+        if start == end:
+            return ""
+        while True:
+            mapped = self.mapped
+            try:
+                if mapped is not None and end <= len(mapped):
+                    data = mapped[start:end]
+                    break
+            except ValueError:  # Closed by a remap in another thread, read from the new map
+                continue
+            self.remap(end)
+        return data.decode('utf-8')
+
+    def remap(self, end):
+        """Map the file again once it holds end bytes, closing the map it replaces."""
+        with self.lock:
+            self.file.flush()
+            if self.mapped is None or end > len(self.mapped):
+                superseded, self.mapped = self.mapped, mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+                if superseded is not None:
+                    superseded.close()
+
+    def compact(self, name, rows):
+        """Copy the given rows to a new store for the persona and return it, leaving the other rows empty.
+
+        Row numbers stay the same, so entries only need to be pointed at the new store.
+        """
+        store = LoreStore.create(name)
+        for row in range(len(self.offsets)):
+            store.append(self.read(row) if row in rows else "")
+        store.flush()
+        return store
+
+class LoreEntry:
+    """One lore entry: its keys in memory, its content in the persona's LoreStore."""
+    __slots__ = ("key", "store", "row")
+
+    def __init__(self, key, store, row):
+        self.key = key
+        self.store = store
+        self.row = row
+
+    @property
+    def content(self):
+        return self.store.read(self.row)
+
+    def estimate_tokens(self):
+        """Rough token count of the content, from its stored length without reading it."""
+        return self.store.lengths[self.row] // CHARS_PER_TOKEN + MESSAGE_TOKEN_OVERHEAD
+
+class Persona:
+    """A bot's system prompt, greeting and keyword index, parsed once and shared by every chat with it."""
+
+    def __init__(self, name):
+        self.name = name
+        self.system_message_file = f"{name}_system.txt"
+        self.system_message = ""
+        self.ai_greeting = ""
+        self.keys_files = []
+        self.keywords = {}
+        self.lore_store = None       # Contents of the entries in self.keywords, which only hold their keys
+        self.keys_file_entries = {}  # Keys file -> {title: entry} it defines, so an edited file can be diffed on reload
+        self.keyword_labels = {}     # Lowercased title or key -> entry, for resolving queued labels
+        self.keyword_matcher = None  # Compiled matcher for all keyword keys, rebuilt by load_keywords
+        self.keyword_overlay = None  # Matcher for the titles added or re-keyed by reloads since keyword_matcher was built
+        self.lore_index = None       # Ranked retrieval over the same entries, rebuilt by load_keywords
+        self.lore_index_stale = False  # Entries changed since the index was built, a rebuild is scheduled
+        self.rebuild_due = None      # When the scheduled background rebuild starts
+        self.rebuild_thread = None
+        self.cache_file = os.path.join(cache_dir, f"{name}.pickle")
+        self.lore_index_file = None  # File the lore index is mapped from, a new one per build
+        self.stamps = {}                    # Sizes and modification times of the files the persona was parsed from
+        self.reload_lock = threading.Lock()
+
+        if self.load_cache():
+            print(f"Loaded system message for bot '{name}' from cache.\n\nLoaded Keyword files:\n" + "\n".join(self.keys_files))
+        else:
+            self.load_system_message()
+            # Taken before parsing, so an edit made while parsing is picked up by the next reload
+            self.stamps = self.source_stamps(self.keys_files)
+            print(f"Loaded system message for bot '{name}'.\n\nLoaded Keyword files:\n" + "\n".join(self.keys_files))
+
+            # Load the filtered keywords from the specified keys files if any are specified
+            if self.keys_files:  # Only attempt to load keywords if keys_files is not empty
+                self.load_keywords(self.keys_files)
+            self.save_cache()
+
+        print(Fore.CYAN + f"Loaded {len(self.keywords)} keywords." + Style.RESET_ALL)
+
+    def source_stamps(self, keys_files):
+        """Modification time and size of the system file and every keys file, to tell when the cache is stale."""
+        stamps = {}
+        for path in [self.system_message_file] + list(keys_files):
+            try:
+                stat = os.stat(path)
+                stamps[path] = (stat.st_mtime_ns, stat.st_size)
+            except FileNotFoundError:
+                if path == self.system_message_file:
+                    raise
+                stamps[path] = None
+        return stamps
+
+    def load_cache(self):
+        """Load the parsed persona and keyword index from the cache if its source files are unchanged."""
+        try:
+            with open(self.cache_file, 'rb') as f:
+                cached = pickle.load(f)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            print(Fore.YELLOW + f"Ignoring unreadable persona cache '{self.cache_file}': {e}" + Style.RESET_ALL)
+            return False
+
+        if cached.get("version") != PERSONA_CACHE_VERSION or cached["stamps"] != self.source_stamps(cached["keys_files"]):
+            return False
+
+        lore_store = None
+        if cached["lore_store"] is not None:
+            lore_store = LoreStore.open(*cached["lore_store"])
+            if lore_store is None:
+                return False  # Contents removed from the cache directory, parse the keys files again
+
+        self.stamps = cached["stamps"]
+        self.system_message = cached["system_message"]
+        self.ai_greeting = cached["ai_greeting"]
+        self.keys_files = cached["keys_files"]
+        self.lore_store = lore_store
+        self.keys_file_entries = {
+            keys_file: {title: LoreEntry(keys, lore_store, row) for title, keys, row in entries}
+            for keys_file, entries in cached["keys_file_entries"].items()
+        }
+        self.keywords = self.merge_keys_files()
+        self.keyword_labels = {label: self.keywords[title] for label, title in cached["keyword_labels"].items()}
+        self.keyword_matcher = KeywordAutomaton.from_state(cached["keyword_matcher"]) if cached["keyword_matcher"] else None
+        self.keyword_overlay = KeywordAutomaton.from_state(cached["keyword_overlay"]) if cached["keyword_overlay"] else None
+        self.lore_index = None
+        if cached["lore_index"] is not None:
+            lore_index_file, build_id, titles = cached["lore_index"]
+            try:
+                self.lore_index = LoreIndex.open(lore_index_file, titles)
+                self.lore_index_file = lore_index_file
+            except (OSError, ValueError):
+                pass
+            if self.lore_index is not None and self.lore_index.build_id != build_id:
+                self.lore_index = None
+        if self.lore_index is None and self.keywords:
+            # Missing, from another build or never written, the parsed entries are enough to redo it
+            self.lore_index = self.build_lore_index(self.keywords)
+            if self.lore_index is not None:
+                self.save_cache()
+        elif cached["lore_index_stale"]:
+            self.schedule_rebuild()  # Saved before the rebuild after an edit finished
+        return True
+
+    def save_cache(self):
+        """Write the parsed persona and compiled keyword index for the next start."""
+        entry_titles = {id(entry): title for title, entry in self.keywords.items()}
+        cached = {
+            "version": PERSONA_CACHE_VERSION,
+            "stamps": self.stamps,
+            "system_message": self.system_message,
+            "ai_greeting": self.ai_greeting,
+            "keys_files": self.keys_files,
+            # Plain data only, so the cache does not depend on the name this script was loaded under
+            "lore_store": (self.lore_store.path, self.lore_store.offsets, self.lore_store.lengths) if self.lore_store else None,
+            "keys_file_entries": {
+                keys_file: [(title, entry.key, entry.row) for title, entry in entries.items()]
+                for keys_file, entries in self.keys_file_entries.items()
+            },
+            "keyword_labels": {label: entry_titles[id(entry)] for label, entry in self.keyword_labels.items() if id(entry) in entry_titles},
+            "keyword_matcher": vars(self.keyword_matcher) if self.keyword_matcher else None,
+            "keyword_overlay": vars(self.keyword_overlay) if self.keyword_overlay else None,
+            "lore_index": (self.lore_index_file, self.lore_index.build_id, self.lore_index.titles) if self.lore_index else None,
+            "lore_index_stale": self.lore_index_stale,
+        }
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            temp_file = f"{self.cache_file}.{os.getpid()}.tmp"  # Other processes running the persona save it too
+            with open(temp_file, 'wb') as f:
+                pickle.dump(cached, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_file, self.cache_file)
+        except (OSError, pickle.PicklingError) as e:
+            print(Fore.YELLOW + f"Could not write persona cache '{self.cache_file}': {e}" + Style.RESET_ALL)
+
+    # Load the system configuration from a plaintext file
+    def load_system_message(self):
+        self.system_message = ""
+        self.ai_greeting = ""
+        self.keys_files = []
+        with open(self.system_message_file, 'r') as file:
+            lines = file.readlines()
+            current_section = "system_message"  # Default to system message section
+        for line in lines:
+            stripped_line = line.strip()
+            if not stripped_line or stripped_line.startswith("#"):  # Ignore empty lines or comments
+                continue
+            if stripped_line == "ai_greeting:":
+                current_section = "ai_greeting"
+            elif stripped_line == "keys_files:":
+                current_section = "keys_files"
+            elif current_section == "ai_greeting":
+                if self.ai_greeting:
+                    self.ai_greeting += " " + stripped_line
                 else:
-                    system_message = stripped_line
-
-except FileNotFoundError:
-    print(Fore.RED + f"Error: System message file '{system_message_file}' not found.")
-    sys.exit(1)
-
-print(f"Loaded system message for bot '{assistant_name}'.\n\nLoaded Keyword files:\n" + "\n".join(keys_files))
-
-# Start with an empty conversation history
-history_file = f"{assistant_name}_history.json"
-
-# Ensure the history directory exists
-history_dir = os.path.join(os.getcwd(), "history")
-os.makedirs(history_dir, exist_ok=True)
+                    self.ai_greeting = stripped_line
+            elif current_section == "keys_files":
+                self.keys_files.append(stripped_line)
+            else:
+                if current_section == "system_message":
+                    if self.system_message:
+                        self.system_message += " " + stripped_line  # Continue reading system message
+                    else:
+                        self.system_message = stripped_line
+
+    # Load the Keyword files specified in the configuration
+    def load_keywords(self, keys_files):
+        # Contents go straight to the store as each line is read, so only keys are kept in memory
+        self.lore_store = LoreStore.create(self.name)
+        for keys_file in keys_files:
+            self.keys_file_entries[keys_file] = {
+                title: LoreEntry(keys, self.lore_store, self.lore_store.append(content))
+                for title, keys, content in self.parse_keys_file(keys_file)
+            }
+        self.lore_store.flush()
+        self.keywords = self.merge_keys_files()
+
+        # The first entry with a given title or key wins, as when entries were searched in load order
+        self.keyword_labels = {}
+        for title, entry in self.keywords.items():
+            self.add_keyword_labels(title, entry)
+
+        # Compile every key into one automaton so matching is a single pass over the input
+        self.keyword_matcher = KeywordAutomaton(self.keywords)
+        self.lore_index = self.build_lore_index(self.keywords)
+
+    def merge_keys_files(self):
+        """Combine the entries of every keys file, a title defined in several files taking the last file's entry."""
+        keywords = {}
+        for keys_file in self.keys_files:
+            keywords.update(self.keys_file_entries.get(keys_file, {}))
+        return keywords
+
+    def winning_entry(self, title):
+        """The entry a title has in the last keys file that defines it, None if no file does anymore."""
+        for keys_file in reversed(self.keys_files):
+            entry = self.keys_file_entries.get(keys_file, {}).get(title)
+            if entry is not None:
+                return entry
+        return None
+
+    def parse_keys_file(self, keys_file):
+        """Yield the (title, keys, content) of every line of one keys file, nothing if it is missing."""
+        try:
+            print(f"Loading keywords file: {keys_file}")
+            with open(keys_file, "r") as file:
+                for line in file:
+                    line = line.strip()
+                    if not line or line.startswith("#"):  # Ignore empty lines or comments
+                        continue
+                    parts = line.split(";")
+                    if len(parts) != 3:
+                        print(f"Warning: Invalid format in line '{line}'. Skipping.")
+                        continue
+                    title, key_string, content = parts
+                    # Strip special characters and newlines from keys
+                    key_string = key_string.replace('', '').replace('', '')
+                    keys = [k.strip() for k in key_string.split(",")]
+                    yield title, keys, content.strip()
+        except FileNotFoundError:
+            print(f"Warning: Keys file '{keys_file}' not found. Skipping.")
 
-def load_history():
-    """Load conversation history if the file exists and is not corrupted."""
-    if os.path.exists(history_file):
+    def add_keyword_labels(self, title, entry):
+        for label in [title, *entry.key]:
+            self.keyword_labels.setdefault(label.strip().lower(), entry)
+
+    def remove_keyword_labels(self, title, entry):
+        for label in [title, *entry.key]:
+            label = label.strip().lower()
+            if self.keyword_labels.get(label) is entry:
+                del self.keyword_labels[label]
+
+    def build_lore_index(self, entries):
+        """Build the ranked lore index over entries, store it next to the persona cache and return it.
+
+        Every build gets a new file, like the lore store, since a file still mapped by a running query
+        or another bot cannot be replaced on Windows.
+        """
+        titles = list(entries)
+        build_id = time.time_ns()
+        lore_index_file = os.path.join(cache_dir, f"{self.name}.{build_id}.lore")
         try:
-            with open(history_file, 'r') as f:
-                data = f.read().strip()
-                if not data:  # If the file is empty
-                    print(Fore.YELLOW + "History file is empty. Starting a new conversation.")
-                    return [{"role": "system", "content": system_message}]
-                history = json.loads(data)
-                return history  # Return parsed JSON data
-        except (json.JSONDecodeError, IOError):
-            print(Fore.RED + "Error: Corrupted or invalid JSON. Starting a new conversation.")
-            return [{"role": "system", "content": system_message}]
-    return [{"role": "system", "content": system_message}]  # Default to new conversation
-
-def save_history(messages):
-    """Save conversation history to a file."""
-    with open(history_file, 'w') as f:
-        json.dump(messages, f)
-
-def backup_history():
-    """Backup the current chat history when the conversation is reset."""
-    if os.path.exists(history_file):
-        # Find the next available backup number
-        backup_number = 1
+            os.makedirs(cache_dir, exist_ok=True)
+            LoreIndex.build(entries, build_id, lore_index_file)
+            lore_index = LoreIndex.open(lore_index_file, titles)
+        except OSError as e:
+            print(Fore.YELLOW + f"Could not write lore index '{lore_index_file}', ranking is off until the next rebuild: {e}" + Style.RESET_ALL)
+            return None
+        self.lore_index_file = lore_index_file
+        self.remove_old_lore_indexes(build_id)
+        return lore_index
+
+    def remove_old_lore_indexes(self, build_id):
+        """Remove the index files of builds older than build_id that no process has open."""
+        prefix = os.path.join(cache_dir, f"{self.name}.")
+        old_files = [os.path.join(cache_dir, f"{self.name}.lore")]  # Written in place by older versions
+        for path in glob.glob(glob.escape(prefix) + "*.lore"):
+            old_build = path[len(prefix):-len(".lore")]
+            # Skip other personas whose name starts with this one, and builds still being written by another process
+            if old_build.isdigit() and int(old_build) < build_id:
+                old_files.append(path)
+        for path in old_files:
+            try:
+                os.remove(path)
+            except OSError:
+                pass  # Missing, or still mapped by a running bot on Windows and left for a later build
+
+    def reload(self):
+        """Re-read the system file and the keys files that changed since they were loaded, return whether any did.
+
+        Entry lookups are patched in place and only the changed keys are compiled, into a small overlay
+        matcher. The ranking index is rebuilt in the background, chats keep using the old one meanwhile.
+        """
+        with self.reload_lock:
+            try:
+                stamps = self.source_stamps(self.keys_files)
+            except FileNotFoundError:
+                return False  # The system file is being replaced, try again on the next poll
+            if stamps == self.stamps:
+                return False
+            changed_files = {path for path, stamp in stamps.items() if self.stamps.get(path) != stamp}
+
+            if self.system_message_file in changed_files:
+                old_keys_files = self.keys_files
+                self.load_system_message()
+                print(Fore.CYAN + f"Reloaded system message for bot '{self.name}'." + Style.RESET_ALL)
+                changed_files.discard(self.system_message_file)
+                changed_files.update(set(old_keys_files) ^ set(self.keys_files))
+                stamps = self.source_stamps(self.keys_files)
+
+            if changed_files:
+                self.reload_keys_files(changed_files)
+            self.stamps = stamps
+            self.save_cache()
+            return True
+
+    def reload_keys_files(self, changed_files):
+        """Apply the difference between the old and new entries of the changed keys files."""
+        if self.lore_store is None:
+            self.lore_store = LoreStore.create(self.name)
+        affected_titles = {}  # Titles the changed files defined before or define now, in order
+        with self.lore_store.shared():
+            for keys_file in changed_files:
+                old_entries = self.keys_file_entries.pop(keys_file, {})
+                affected_titles.update(dict.fromkeys(old_entries))
+                if keys_file in self.keys_files:
+                    entries = {}
+                    for title, keys, content in self.parse_keys_file(keys_file):
+                        # Unchanged entries keep their stored content, only new text is appended to the store
+                        old_entry = old_entries.get(title)
+                        if old_entry is not None and old_entry.key == keys and old_entry.content == content:
+                            entries[title] = old_entry
+                        else:
+                            entries[title] = LoreEntry(keys, self.lore_store, self.lore_store.append(content))
+                    self.keys_file_entries[keys_file] = entries
+                    affected_titles.update(dict.fromkeys(entries))
+
+        added = changed = removed = 0
+        rekeyed_titles = []  # Added or with new keys, so the compiled automaton no longer matches them right
+        for title in affected_titles:
+            # Another keys file may still define the title, or have been shadowing it
+            entry = self.winning_entry(title)
+            old_entry = self.keywords.get(title)
+            if old_entry is entry:
+                continue
+            if old_entry is not None:
+                self.remove_keyword_labels(title, old_entry)
+            if entry is None:
+                del self.keywords[title]
+                removed += 1
+                continue
+            if old_entry is None:
+                added += 1
+                rekeyed_titles.append(title)
+            else:
+                changed += 1
+                if old_entry.key != entry.key:
+                    rekeyed_titles.append(title)
+            self.keywords[title] = entry
+            self.add_keyword_labels(title, entry)
+
+        if not (added or changed or removed):
+            return
+        # Removed titles need nothing, matches are looked up by title. New keys go into the overlay,
+        # which the background rebuild folds into the full automaton once it grows large.
+        if self.keyword_matcher is None:
+            self.keyword_matcher = KeywordAutomaton(dict(self.keywords))
+        elif rekeyed_titles:
+            overlay_titles = dict.fromkeys(self.keyword_overlay.titles if self.keyword_overlay else [])
+            overlay_titles.update(dict.fromkeys(rekeyed_titles))
+            overlay_entries = {title: self.keywords[title] for title in overlay_titles if title in self.keywords}
+            self.keyword_overlay = KeywordAutomaton(overlay_entries) if overlay_entries else None
+        self.lore_index_stale = True
+        self.schedule_rebuild()
+        print(Fore.CYAN + f"Reloaded keywords for bot '{self.name}': {added} added, {changed} changed, {removed} removed." + Style.RESET_ALL)
+
+    def schedule_rebuild(self):
+        """Rebuild the ranking index on a background thread once no edit has come in for LORE_REBUILD_DELAY_SECONDS."""
+        self.rebuild_due = time.monotonic() + LORE_REBUILD_DELAY_SECONDS
+        if self.rebuild_thread is None or not self.rebuild_thread.is_alive():
+            self.rebuild_thread = threading.Thread(target=self.run_rebuilds, daemon=True)
+            self.rebuild_thread.start()
+
+    def run_rebuilds(self):
         while True:
-            backup_file = os.path.join(history_dir, f"{assistant_name}_history_{backup_number}.json")
-            if not os.path.exists(backup_file):
+            with self.reload_lock:
+                delay = self.rebuild_due - time.monotonic()
+                if delay <= 0:
+                    self.rebuild_due = None
+                    try:
+                        self.rebuild_indexes()
+                    except Exception as e:
+                        print(Fore.RED + f"Error rebuilding the lore index of bot '{self.name}': {e}" + Style.RESET_ALL)
+                    self.rebuild_thread = None
+                    return
+            time.sleep(delay)
+
+    def rebuild_indexes(self):
+        """Rebuild the ranking index, fold a large overlay into the full automaton and compact the store. Called with reload_lock held."""
+        start_time = time.perf_counter()
+        if self.lore_store is not None:
+            self.compact_lore_store()
+        entries = dict(self.keywords)
+        overlay = self.keyword_overlay
+        if overlay is not None and len(overlay.titles) > max(KEYWORD_OVERLAY_MAX, KEYWORD_OVERLAY_FRACTION * len(entries)):
+            self.keyword_matcher = KeywordAutomaton(entries)
+            self.keyword_overlay = None
+        self.lore_index = self.build_lore_index(entries)
+        self.lore_index_stale = False
+        self.save_cache()
+        print(Fore.CYAN + f"Rebuilt the lore index of bot '{self.name}' in {time.perf_counter() - start_time:.1f}s." + Style.RESET_ALL)
+
+    def compact_lore_store(self):
+        """Move the contents still in use to a new store when most of the current one was replaced by reloads.
+
+        The old store closes its file and map once the last running read lets go of it.
+        """
+        store = self.lore_store
+        live_entries = {id(entry): entry for entries in self.keys_file_entries.values() for entry in entries.values()}
+        rows = {entry.row for entry in live_entries.values()}
+        used = sum(store.lengths[row] for row in rows)
+        size = os.fstat(store.file.fileno()).st_size  # Includes what other processes appended
+        if size <= max(LORE_STORE_COMPACT_RATIO * used, used + LORE_STORE_COMPACT_MIN_BYTES):
+            return
+        compacted = store.compact(self.name, rows)
+        for entry in live_entries.values():
+            entry.store = compacted
+        self.lore_store = compacted
+        print(Fore.CYAN + f"Compacted the lore store of bot '{self.name}' from {size / 1e6:.1f} MB to {used / 1e6:.1f} MB." + Style.RESET_ALL)
+
+    # Collect the entries whose keys appear in the input text, using the compiled automaton
+    def find_matching_keywords(self, input_text, whole_word=None):
+        if whole_word is None:
+            whole_word = whole_word_keywords
+
+        matching_keywords = []
+        keyword_matcher = self.keyword_matcher
+        if keyword_matcher is None:  # No keys files loaded
+            return matching_keywords
+
+        overlay = self.keyword_overlay
+        overlay_titles = set(overlay.titles) if overlay is not None else ()
+        for title_index in keyword_matcher.search(input_text, whole_word):
+            title = keyword_matcher.titles[title_index]
+            if title in overlay_titles:  # Keys changed since the automaton was compiled, matched by the overlay below
+                continue
+            entry = self.keywords.get(title)
+            if entry is not None:  # Removed by a reload since the automaton was compiled
+                matching_keywords.append(entry)
+        if overlay is not None:
+            for title_index in overlay.search(input_text, whole_word):
+                entry = self.keywords.get(overlay.titles[title_index])
+                if entry is not None:
+                    matching_keywords.append(entry)
+
+        return matching_keywords
+
+    def find_relevant_keywords(self, input_text, top_k=LORE_TOP_K, token_budget=LORE_TOKEN_BUDGET):
+        """Return the entries ranked most relevant to the input, best first, until top_k or the token budget is reached."""
+        relevant_keywords = []
+        lore_index = self.lore_index
+        if lore_index is None:
+            return relevant_keywords
+
+        tokens = 0
+        for score, entry_id in lore_index.search(input_text, top_k):
+            if score < LORE_MIN_SCORE:
                 break
-            backup_number += 1
-        
-        # Copy the current history file to the backup file
-        with open(history_file, 'r') as src, open(backup_file, 'w') as dst:
-            dst.write(src.read())
-        print(Fore.GREEN + f"Backup created: {backup_file}")
-
-def repeat_last_message(messages):
-    """Repeat the last assistant message if it exists."""
-    if len(messages) > 1:  # Check if there's more than just the system message
-        for msg in reversed(messages):
-            if msg['role'] == 'assistant':
-                print(Fore.GREEN + f"\n- {assistant_name} (Last Message):\n" + Style.RESET_ALL + f"{msg['content']}")
+            entry = self.keywords.get(lore_index.titles[entry_id])
+            if entry is None:  # Removed by a reload, the index is rebuilt in the background
+                continue
+            tokens += entry.estimate_tokens()
+            if tokens > token_budget:
                 break
-    else:
-        print(Fore.YELLOW + "No previous conversation found.")
+            relevant_keywords.append(entry)
+        return relevant_keywords
+
+# Parsed personas, shared by every session in this process
+personas = {}
+personas_lock = threading.Lock()
+
+def get_persona(name):
+    """Return the parsed persona for a bot name, parsing its files the first time it is used."""
+    with personas_lock:
+        if name not in personas:
+            personas[name] = Persona(name)
+        return personas[name]
+
+def watch_personas():
+    """Reload the edited files of every loaded persona, checking every RELOAD_POLL_SECONDS."""
+    while True:
+        time.sleep(RELOAD_POLL_SECONDS)
+        with personas_lock:
+            loaded = list(personas.values())
+        for persona in loaded:
+            try:
+                persona.reload()
+            except Exception as e:
+                print(Fore.RED + f"Error reloading bot '{persona.name}': {e}" + Style.RESET_ALL)
+
+def start_persona_watcher():
+    threading.Thread(target=watch_personas, daemon=True).start()
+
+def list_personas():
+    """List the bot names of every *_system.txt file in cwd."""
+    return sorted(os.path.basename(path)[:-len("_system.txt")] for path in glob.glob("*_system.txt"))
+
+class KeywordScheduler:
+    """Lore entries waiting to be injected, and the ones whose reference block is still in the context window."""
+
+    def __init__(self):
+        self.queue = []    # Heap of (rank, -turn, order, label), items replaced in pending are skipped when popped
+        self.pending = {}  # label -> its current heap item
+        self.live = {}     # label -> (index in the history, reference message) of its last injection
+        self.turn = 0
+        self.order = 0
+
+    def track_history(self, messages, window_start):
+        """Mark the reference blocks already in the window of a loaded history as live."""
+        self.live = {}
+        for index in range(window_start, len(messages)):
+            content = messages[index].get("content") or ""
+            if messages[index].get("role") == "system" and content.startswith(REFERENCE_PREFIX):
+                self.live[content[len(REFERENCE_PREFIX):].split("\n", 1)[0]] = (index, messages[index])
+
+    def is_live(self, label, messages, window_start):
+        """Check whether the label's reference block is still in the window, forgetting it once it is not."""
+        injected = self.live.get(label)
+        if injected is None:
+            return False
+        index, message = injected
+        if window_start <= index < len(messages) and messages[index] is message:
+            return True
+        del self.live[label]  # Summarized away, rolled back or retried
+        return False
+
+    def push(self, label, rank):
+        """Queue a mentioned label, or move it up if it was already queued with a lower priority."""
+        item = (rank, -self.turn, self.order, label)
+        self.order += 1
+        current = self.pending.get(label)
+        if current is None or item < current:
+            self.pending[label] = item
+            heapq.heappush(self.queue, item)
+
+    def peek(self):
+        """Return the best queued label without removing it, dropping replaced and expired items on the way."""
+        while self.queue:
+            item = self.queue[0]
+            label = item[3]
+            if self.pending.get(label) is not item:
+                heapq.heappop(self.queue)
+            elif -item[1] <= self.turn - KEYWORD_PENDING_TURNS:
+                heapq.heappop(self.queue)
+                del self.pending[label]
+            else:
+                return label
+        return None
+
+    def pop(self):
+        """Remove and return the best queued label, or None."""
+        label = self.peek()
+        if label is not None:
+            heapq.heappop(self.queue)
+            del self.pending[label]
+        return label
+
+class ReplyCandidates:
+    """Replies generated concurrently for one retry, in the order they finished, and which one is in the history."""
+
+    def __init__(self, futures):
+        self.pending = set(futures)
+        self.replies = []
+        self.selected = 0
+        self.message = None  # The history message holding the selected reply
+
+    def total(self):
+        return len(self.replies) + len(self.pending)
+
+    def wait_next(self):
+        """Block until at least one more candidate is ready, and return False once every one has finished."""
+        count = len(self.replies)
+        error = None
+        while self.pending and len(self.replies) == count:
+            done, self.pending = wait(self.pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    self.replies.append(future.result())
+                except Exception as e:
+                    error = e
+        if not self.replies and error is not None:
+            raise error  # Every candidate failed
+        return len(self.replies) > count
+
+class ChatSession:
+    """One conversation with a persona: its history, rolling summary, pending keywords and toggles."""
+
+    def __init__(self, persona, session_id=None, echo=True, directory=None):
+        self.persona = persona
+        self.session_id = session_id
+        self.echo = echo  # Print replies, token by token when streaming, as the interactive chat does
+
+        # The history is a snapshot file plus an append-only journal of the changes made since it was written
+        if session_id is None:
+            self.file_prefix = persona.name
+            self.history_file = f"{persona.name}_history.json"
+        else:
+            directory = directory or sessions_dir
+            os.makedirs(directory, exist_ok=True)
+            self.file_prefix = f"{persona.name}_{session_id}"
+            self.history_file = os.path.join(directory, f"{self.file_prefix}_history.json")
+        self.journal_file = self.history_file[:-len(".json")] + ".journal.jsonl"
+        # Where older versions kept the rolling summary, it is saved with the history now
+        self.summary_file = self.history_file[:-len("_history.json")] + "_summary.json"
+
+        # What the snapshot plus journal on disk currently hold, so each save only writes the difference
+        self.saved_messages = []
+        self.history_generation = 0
+        self.journal_entries = 0
+
+        # Rolling summary of the turns that no longer fit in the window, and the index where the window starts.
+        # Saved with the history, so it always describes the conversation it was loaded with
+        self.history_summary = new_summary()
+
+        # Mentioned lore waiting to be injected, and the reference blocks already in the window
+        self.keyword_scheduler = KeywordScheduler()
+
+        self.tts_enabled = False
+        self.stream_enabled = True
+
+        # Timings of every generated reply: time to first token and total generation time
+        self.response_timings = []
+
+        # Sketches of recent replies for the repetition check, keyed by id() with the message kept alongside
+        self.reply_sketches = {}
+
+        # Candidates of the last retry, to swipe between while their reply is the last message
+        self.reply_candidates = None
+
+        # Speech of the last generated reply, so it can be cut short if the reply is thrown away
+        self.reply_speech = None
+
+        # Load the conversation history first
+        self.messages = self.load_history()
+
+        # Histories trimmed by older versions can have lost the persona prompt, pin it again
+        if not self.messages or not is_persona_message(self.messages[0]):
+            self.messages.insert(0, {"role": "system", "content": persona.system_message})
+
+        self.keyword_scheduler.track_history(self.messages, self.history_summary["window_start"])
+
+    def new_history(self):
+        """Return the history of a new conversation."""
+        return [{"role": "system", "content": self.persona.system_message}]
+
+    def load_history(self):
+        """Load the conversation snapshot and replay the journal written since it."""
+        messages = None
+        summary = None
+        self.history_generation = 0
+        self.history_summary = new_summary()
+        if os.path.exists(self.history_file):
+            try:
+                with open(self.history_file, 'r') as f:
+                    data = f.read().strip()
+                if not data:  # If the file is empty
+                    print(Fore.YELLOW + "History file is empty. Starting a new conversation.")
+                else:
+                    snapshot = json.loads(data)
+                    if isinstance(snapshot, list):  # Plain list written by older versions
+                        messages = snapshot
+                    else:
+                        self.history_generation = snapshot["generation"]
+                        messages = snapshot["messages"]
+                        summary = snapshot.get("summary")
+            except (json.JSONDecodeError, IOError, KeyError, TypeError):
+                # Keep the broken file around instead of silently overwriting it on the next save
+                corrupt_file = self.history_file + ".corrupt"
+                os.replace(self.history_file, corrupt_file)
+                print(Fore.RED + f"Error: Corrupted or invalid JSON, moved to '{corrupt_file}'. Starting a new conversation.")
+                messages = None
+
+        if messages is None:
+            self.saved_messages = []
+            self.journal_entries = 0
+            return self.new_history()  # Default to new conversation
+
+        # Replay the journal, but only if it was started on top of this snapshot
+        records, torn_journal = read_journal(self.journal_file, self.history_generation)
+        self.journal_entries = len(records) if records is not None else 0
+        if records is not None:
+            summary = replay_journal(messages, records) or summary
+
+        if summary is None:
+            summary = self.load_legacy_summary()
+        if summary is not None:
+            self.history_summary = summary
+
+        self.saved_messages = list(messages)
+        if torn_journal or records is None:  # Start a journal that matches the snapshot
+            self.compact_history(messages)
+        return messages
+
+    def compact_history(self, messages=None):
+        """Write a full snapshot of the conversation and start an empty journal on top of it."""
+        if messages is None:
+            messages = self.messages
+        self.history_generation += 1
+        replace_file(self.history_file, json.dumps({"generation": self.history_generation, "messages": messages, "summary": self.history_summary}))
+        # A crash before the journal is replaced leaves a journal for the old generation, which is ignored
+        replace_file(self.journal_file, json.dumps({"op": "base", "generation": self.history_generation}) + "\n")
+        self.saved_messages = list(messages)
+        self.journal_entries = 0
+
+    def save_history(self, messages=None):
+        """Append the messages added since the last save to the journal.
+
+        Messages are compared by identity, so the history must only change by appending,
+        truncating or replacing the list. Edit a message in place and call compact_history instead.
+        """
+        if messages is None:
+            messages = self.messages
+        saved_messages = self.saved_messages
+        saved_length = len(saved_messages)
+
+        # Find how much of what is on disk is still the start of the conversation
+        common_length = min(len(messages), saved_length)
+        while common_length and messages[common_length - 1] is not saved_messages[common_length - 1]:
+            common_length -= 1
+
+        if not common_length or self.journal_entries >= JOURNAL_COMPACT_EVERY:
+            self.compact_history(messages)
+            return
+
+        records = []
+        if common_length < saved_length:  # Messages were dropped from the end, e.g. by a retry
+            records.append({"op": "truncate", "length": common_length})
+            del saved_messages[common_length:]
+        for message in messages[common_length:]:
+            records.append({"op": "append", "message": message})
+            saved_messages.append(message)
+
+        if records:
+            with open(self.journal_file, 'a') as f:
+                f.write("".join(json.dumps(record) + "\n" for record in records))
+            self.journal_entries += len(records)
+
+    def backup_history(self):
+        """Backup the current chat history when the conversation is reset."""
+        if os.path.exists(self.history_file):
+            # Name the backup after the time, only probing further if another reset happened in the same second
+            backup_name = f"{self.file_prefix}_history_{time.strftime('%Y%m%d-%H%M%S')}"
+            backup_file = os.path.join(history_dir, f"{backup_name}.json")
+            suffix = 1
+            while True:
+                try:
+                    dst = open(backup_file, 'x')
+                    break
+                except FileExistsError:
+                    suffix += 1
+                    backup_file = os.path.join(history_dir, f"{backup_name}-{suffix}.json")
+
+            # Write the saved history (snapshot plus journal) to the backup file as a plain list
+            with dst:
+                json.dump(self.saved_messages, dst)
+            print(Fore.GREEN + f"Backup created: {backup_file}")
+
+    def reset(self):
+        """Back up the conversation and start a new one."""
+        self.backup_history()
+        self.history_summary = new_summary()
+        self.messages = self.new_history()
+        self.save_history()
+        self.keyword_scheduler = KeywordScheduler()
+        self.reply_candidates = None
+
+    def load_legacy_summary(self):
+        """Return the rolling summary older versions kept in <name>_summary.json, if there is one."""
+        if os.path.exists(self.summary_file):
+            try:
+                with open(self.summary_file, 'r') as f:
+                    return json.load(f)
+            except (json.JSONDecodeError, IOError):
+                print(Fore.RED + "Error: Corrupted summary file. Starting without a summary.")
+        return None
+
+    def save_summary(self):
+        """Record the rolling summary in the journal, next to the messages it describes."""
+        if not self.saved_messages or self.journal_entries >= JOURNAL_COMPACT_EVERY:
+            self.compact_history(self.saved_messages or self.messages)
+            return
+        with open(self.journal_file, 'a') as f:
+            f.write(json.dumps({"op": "summary", "summary": self.history_summary}) + "\n")
+        self.journal_entries += 1
+
+    def update_summary(self, evicted_messages):
+        """Fold turns that left the context window into the rolling summary with one extra API call."""
+        transcript = "\n".join(
+            f"{self.persona.name if msg['role'] == 'assistant' else 'User'}: {msg['content']}"
+            for msg in evicted_messages
+            if msg['role'] != 'system'  # Reference material is injected again when it comes up
+        )
+        if not transcript:
+            return
+
+        summary_request = [
+            {"role": "system", "content": "You keep a running summary of a roleplay conversation. Reply with the updated summary only."},
+            {"role": "user", "content": f"Current summary:\n{self.history_summary['text'] or '(none yet)'}\n\nEvents that happened next:\n{transcript}\n\nUpdate the summary so it includes the new events. Keep names, places, goals, relationships and the current situation. Use at most {SUMMARY_MAX_WORDS} words."}
+        ]
+        print(Fore.YELLOW + f"Summarizing {len(evicted_messages)} older messages..." + Style.RESET_ALL)
+        try:
+            response = get_client().chat(**params, messages=summary_request)
+            self.history_summary["text"] = response.message.content[0].text.strip()
+        except Exception as e:
+            print(Fore.RED + f"Error updating the conversation summary: {e}. Older turns are dropped without a summary.")
+
+    def build_context(self, messages=None):
+        """Assemble the messages to send: pinned persona prompt, rolling summary and as many of the newest turns as fit."""
+        if messages is None:
+            messages = self.messages
+        pinned = messages[0] if messages and is_persona_message(messages[0]) else {"role": "system", "content": self.persona.system_message}
+        first_turn = 1 if messages and messages[0] is pinned else 0
+
+        # Retries can leave the window start past the end of the history, the newest message is always sent
+        window_start = min(max(self.history_summary["window_start"], first_turn), max(len(messages) - 1, first_turn))
+
+        summary_message = None
+        if self.history_summary["text"]:
+            summary_message = {"role": "system", "content": f"[Summary of the conversation so far:\n{self.history_summary['text']}]"}
+
+        budget = CONTEXT_TOKEN_BUDGET - estimate_tokens(pinned) - SUMMARY_MAX_WORDS * 2
+        window_tokens = sum(estimate_tokens(msg) for msg in messages[window_start:])
+
+        if window_tokens > budget:
+            # Fill newest-first down to a lower mark, so the next few turns fit without another eviction
+            fill_budget = budget - SUMMARY_BATCH_TOKENS
+            new_start = len(messages)
+            used_tokens = 0
+            while new_start > window_start:
+                tokens = estimate_tokens(messages[new_start - 1])
+                if used_tokens + tokens > fill_budget and new_start < len(messages):
+                    break
+                used_tokens += tokens
+                new_start -= 1
+
+            self.update_summary(messages[window_start:new_start])
+            self.history_summary["window_start"] = new_start
+            self.save_summary()
+            window_start = new_start
+            if self.history_summary["text"]:
+                summary_message = {"role": "system", "content": f"[Summary of the conversation so far:\n{self.history_summary['text']}]"}
+
+        context = [pinned]
+        if summary_message:
+            context.append(summary_message)
+        context.extend(messages[window_start:])
+        return context
+
+    def repeat_last_message(self):
+        """Repeat the last assistant message if it exists."""
+        if len(self.messages) > 1:  # Check if there's more than just the system message
+            for msg in reversed(self.messages):
+                if msg['role'] == 'assistant':
+                    print(Fore.GREEN + f"\n- {self.persona.name} (Last Message):\n" + Style.RESET_ALL + f"{msg['content']}")
+                    break
+        else:
+            print(Fore.YELLOW + "No previous conversation found.")
+
+    # Retry the last response if the user types 'retry'
+    def retry_last_response(self, additional_instruction=None):
+        """Retry the last user message with an optional additional instruction."""
+        self.sync_persona()
 
-# Retry the last response if the user types 'retry'
-def retry_last_response(messages, additional_instruction=None):
-    """Retry the last user message with an optional additional instruction."""
-    if len(messages) > 1:  # Check if there's more than just the system message
         # Find the last user message
-        for i in range(len(messages) - 1, -1, -1):
-            if messages[i]['role'] == 'user' and messages[i]['content'].strip():
-                user_message = messages[i]['content'].strip()
-                # Remove all messages after this user message (ignoring the last assistant response)
-                messages = messages[:i + 1]
+        for i in range(len(self.messages) - 1, 0, -1):
+            if self.messages[i]['role'] == 'user' and self.messages[i]['content'].strip():
                 break
+        else:
+            print(Fore.YELLOW + "No valid user message found to retry.")
+            return
+
+        # Remove all messages after this user message (ignoring the last assistant response)
+        messages = self.messages[:i + 1]
 
         # If additional instruction is provided, add it as a system message before retrying
         if additional_instruction:
@@ -180,298 +1879,984 @@ def retry_last_response(messages, additional_instruction=None):
             # Add the additional instruction as a system message
             messages.append({"role": "system", "content": additional_instruction})
 
-        # Debug: Print the message history to verify it before the API call
-        print(Fore.CYAN + "\nDebug: Message history before retry:\n" + Style.RESET_ALL, json.dumps(messages, indent=2))
+        # Debug: Print the assembled context to verify it before the API call
+        context = self.assemble_context(messages)
+        print(Fore.CYAN + "\nDebug: Message history before retry:\n" + Style.RESET_ALL, json.dumps(context, indent=2))
 
         # Call the Cohere chat API with the adjusted message history
         try:
-            response = co.chat(
-                **params,  # Keep the model and parameters consistent
-                messages=messages  # Override the messages parameter with the updated message list
-            )
-
-            # Extract the new assistant's response
-            assistant_response = response.message.content[0].text  # Adjust the attribute path if necessary
-
-            # Simulate streaming of the assistant's response in chunks
-            print(Fore.GREEN + f"\n- {assistant_name} (Retry):\n" + Style.RESET_ALL, end='')
-            display_response(assistant_response)  # Stream the response
+            if RETRY_CANDIDATES > 1:
+                candidates = self.generate_candidates(context, " (Retry)")
+                assistant_message = {"role": "assistant", "content": candidates.replies[0]}
+                candidates.message = assistant_message
+            else:
+                # Stream (or print) the new assistant's response with the adjusted message history
+                candidates = None
+                assistant_message = {"role": "assistant", "content": self.generate_response(context, " (Retry)")}
 
-            # Append the new assistant's response to the message history
-            messages.append({"role": "assistant", "content": assistant_response})
+            # The retried history replaces the session's, so the next turn continues from it
+            messages.append(assistant_message)
+            self.messages = messages
+            self.reply_candidates = candidates
 
             # Save the updated history after the retry
-            save_history(messages)
-
-            # Generate speech from the assistant's response
-            generate_speech(assistant_response)
+            with metrics.span("save_history"):
+                self.save_history()
         except Exception as e:
             print(Fore.RED + f"Error during retry: {str(e)}")
-    else:
-        print(Fore.YELLOW + "No valid user message found to retry.")
+        metrics.export()
+
+    def generate_candidate(self, messages, temperature):
+        """Generate one retry candidate, run on the candidate threads."""
+        with metrics.span("chat", candidate=True, temperature=temperature) as chat_span:
+            response = get_client().chat(
+                **{**params, "temperature": temperature, "seed": random.randrange(2 ** 31)},
+                messages=messages
+            )
+            reply = response.message.content[0].text
+            input_tokens, output_tokens = usage_tokens(getattr(response, "usage", None))
+            chat_span.update(response_chars=len(reply), input_tokens=input_tokens, output_tokens=output_tokens)
+        return reply
+
+    def generate_candidates(self, messages, label=""):
+        """Request RETRY_CANDIDATES replies at once and show the first to finish, the rest keep generating."""
+        start_time = time.perf_counter()
+        temperatures = []
+        for candidate in range(RETRY_CANDIDATES):
+            offset = RETRY_TEMPERATURE_STEP * ((candidate + 1) // 2) * (1 if candidate % 2 else -1)
+            temperatures.append(round(min(1.0, max(0.0, params["temperature"] + offset)), 2))
+
+        candidates = ReplyCandidates([candidate_executor.submit(self.generate_candidate, messages, t) for t in temperatures])
+        candidates.wait_next()
+        total_time = time.perf_counter() - start_time
+        self.response_timings.append({"first_token": total_time, "total": total_time})
+        self.show_candidate(candidates, label)
+        if self.echo:
+            print(Fore.CYAN + f"(Generated in {total_time:.2f}s)" + Style.RESET_ALL)
+        return candidates
+
+    def show_candidate(self, candidates, label=""):
+        """Print and speak the selected candidate."""
+        reply = candidates.replies[candidates.selected]
+        if self.echo:
+            print(Fore.GREEN + f"\n- {self.persona.name}{label}:\n" + Style.RESET_ALL, end='')
+            display_response(reply)
+            print(Fore.CYAN + f"(Candidate {candidates.selected + 1}/{candidates.total()}, 'swipe' for the next)" + Style.RESET_ALL)
+        if self.tts_enabled:
+            generate_speech(reply)
+
+    def swipe(self, number=None):
+        """Replace the last reply with the next retry candidate, or with candidate number (counted from 1)."""
+        candidates = self.reply_candidates
+        if candidates is None or self.messages[-1] is not candidates.message:
+            print(Fore.YELLOW + "No candidates to swipe through, retry the last response first.")
+            return
+
+        if number is None:
+            index = candidates.selected + 1
+            if index == len(candidates.replies) and not candidates.wait_next():
+                index = 0  # Every candidate has been shown, start over
+        else:
+            index = number - 1
+            while index >= len(candidates.replies) and candidates.wait_next():
+                pass
+            if not 0 <= index < len(candidates.replies):
+                print(Fore.YELLOW + f"There are only {len(candidates.replies)} candidates.")
+                return
+
+        # A new message object, so the journal records the swap
+        candidates.selected = index
+        candidates.message = {"role": "assistant", "content": candidates.replies[index]}
+        self.messages[-1] = candidates.message
+        self.save_history()
+        self.show_candidate(candidates, " (Swipe)")
+
+    def stream_response(self, messages, speech=None):
+        """Stream the assistant's response as it arrives, printing and speaking each token, and return the full text."""
+        start_time = time.perf_counter()
+        first_token_time = None
+        response_parts = []
+        usage = None
+
+        for event in get_client().chat_stream(**params, messages=messages):
+            if event.type == "message-end":
+                usage = getattr(event.delta, "usage", None)
+            elif event.type == "content-delta":
+                text = event.delta.message.content.text
+                if first_token_time is None:
+                    first_token_time = time.perf_counter() - start_time
+                response_parts.append(text)
+                if self.echo:
+                    print(text, end='', flush=True)
+                if speech:
+                    speech.feed(text)
+        if self.echo:
+            print()
+
+        total_time = time.perf_counter() - start_time
+        return "".join(response_parts), first_token_time if first_token_time is not None else total_time, total_time, usage
+
+    def generate_response(self, messages, label=""):
+        """Get the assistant's reply for the message history, streamed or blocking, and display it."""
+        if self.echo:
+            print(Fore.GREEN + f"\n- {self.persona.name}{label}:\n" + Style.RESET_ALL, end='')
+
+        # Speech starts with the first complete sentence instead of after the whole reply
+        speech = SpeechPipeline() if self.tts_enabled else None
+        self.reply_speech = speech
+
+        with metrics.span("chat") as chat_span:
+            if self.stream_enabled:
+                assistant_response, first_token_time, total_time, usage = self.stream_response(messages, speech)
+            else:
+                start_time = time.perf_counter()
+                response = get_client().chat(
+                    **params,  # Use the appropriate model and parameters
+                    messages=messages
+                )
+                assistant_response = response.message.content[0].text
+                usage = getattr(response, "usage", None)
+                # Nothing is shown before the whole reply arrives, so the first token is the last one
+                first_token_time = total_time = time.perf_counter() - start_time
+                if self.echo:
+                    display_response(assistant_response)
+                if speech:
+                    speech.feed(assistant_response)
+
+            input_tokens, output_tokens = usage_tokens(usage)
+            chat_span.update(first_token=first_token_time, response_chars=len(assistant_response),
+                             input_tokens=input_tokens, output_tokens=output_tokens)
+
+        if speech:
+            with metrics.span("tts_queue"):
+                speech.finish()
+
+        self.response_timings.append({"first_token": first_token_time, "total": total_time})
+        if self.echo:
+            print(Fore.CYAN + f"(First token after {first_token_time:.2f}s, generated in {total_time:.2f}s)" + Style.RESET_ALL)
+        return assistant_response
+
+    def auto_send_recap(self):
+        """Automatically send a recap message if the user types 'recap'."""
+        recap_message = "(OOC: Pause Roleplay and lets recap the events. Before we resume i just want to check up on you so you are on the right track in the roleplay. Can you answer these questions for me: 1. What is the plot? 2. What is the setting? 3. What are our goals? 4. What is your role and my role? 5. What is the current situation? Feel free to use OOC at any point if you have any questions.)"
+        self.messages.append({"role": "user", "content": recap_message})
+        self.save_history()
+
+    def append_new_keywords(self, matching_keywords, input_text=None):
+        """Queue the mentioned entries and inject the best queued ones that are not already in the window."""
+        scheduler = self.keyword_scheduler
+        scheduler.turn += 1
+        window_start = self.history_summary["window_start"]
+
+        # Exact key matches come first, then the entries ranked most relevant to the message
+        ranked_keywords = self.persona.find_relevant_keywords(input_text) if input_text else []
+        for rank, keywords in enumerate((matching_keywords, ranked_keywords)):
+            for keyword in keywords:
+                label = keyword_label(keyword)
+                if label and not scheduler.is_live(label, self.messages, window_start):
+                    scheduler.push(label, rank)
+
+        # Inject queued entries until the turn's budget is spent, the rest wait for the next turns
+        used_tokens = 0
+        while True:
+            keyword_to_send = scheduler.peek()
+            if keyword_to_send is None:
+                break
+
+            entry = self.persona.keyword_labels.get(keyword_to_send)
+            keyword_content = entry.content if entry else None
+            if not keyword_content:
+                scheduler.pop()
+                print(Fore.RED + f"No content found for keyword: '{keyword_to_send}'. Skipping." + Style.RESET_ALL)
+                continue
+
+            # Concatenate the keyword and its content into a concise message, wrapped in square brackets
+            reference_message = {"role": "system", "content": f"{REFERENCE_PREFIX}{keyword_to_send}\n{keyword_content}]"}
+            tokens = estimate_tokens(reference_message)
+            if used_tokens and used_tokens + tokens > KEYWORD_INJECTION_TOKEN_BUDGET:
+                break
+            used_tokens += tokens
+            scheduler.pop()
+            if self.echo:
+                print(Fore.GREEN + f"Processing keyword: {keyword_to_send}" + Style.RESET_ALL)
+
+            # Add it as a 'system' message to provide context without influencing behavior
+            scheduler.live[keyword_to_send] = (len(self.messages), reference_message)
+            self.messages.append(reference_message)
+
+    def repetition_score(self, reply):
+        """Return the highest similarity between a reply and the last REPETITION_WINDOW replies."""
+        previous_replies = []
+        for msg in reversed(self.messages):
+            if msg['role'] == 'assistant':
+                previous_replies.append(msg)
+                if len(previous_replies) == REPETITION_WINDOW:
+                    break
+
+        # Only replies that are new to the window get sketched, the rest come from the cache
+        sketches = {}
+        for msg in previous_replies:
+            cached = self.reply_sketches.get(id(msg))
+            sketches[id(msg)] = cached if cached and cached[0] is msg else (msg, reply_sketch(msg['content']))
+        self.reply_sketches = sketches
+
+        new_sketch = reply_sketch(reply)
+        return max((sketch_similarity(new_sketch, sketch) for _, sketch in sketches.values()), default=0.0)
+
+    def sync_persona(self):
+        """Pin the persona's current system prompt if its file was edited since the conversation last used it."""
+        pinned = self.messages[0]
+        if is_persona_message(pinned) and pinned["content"] != self.persona.system_message:
+            # Replaced rather than edited, and written as a full snapshot since the journal only records appends
+            self.messages[0] = {"role": "system", "content": self.persona.system_message}
+            self.compact_history()
+
+    def assemble_context(self, messages=None):
+        """build_context wrapped in a span that records the request size."""
+        with metrics.span("context") as context_span:
+            context = self.build_context(messages)
+            context_span.update(messages=len(context), chars=sum(len(msg.get("content") or "") for msg in context),
+                                estimated_tokens=sum(estimate_tokens(msg) for msg in context))
+        return context
+
+    def chat_turn(self, user_input):
+        """Run one turn: inject matching lore, send the budgeted context and save the reply."""
+        try:
+            with metrics.span("turn"):
+                return self.run_turn(user_input)
+        finally:
+            metrics.export()
+
+    def run_turn(self, user_input):
+        self.sync_persona()
+        turn_start = len(self.messages)
+        try:
+            with metrics.span("keywords") as keywords_span:
+                # Find any matching entries for user input
+                matching_keywords = self.persona.find_matching_keywords(user_input)
+
+                # Append new keywords without splitting multi-word phrases, plus the best ranked entries
+                self.append_new_keywords(matching_keywords, user_input)
+                keywords_span["matches"] = len(matching_keywords)
+
+            # Append the user's message (with context) to the message history
+            self.messages.append({"role": "user", "content": user_input})
+
+            # Call the Cohere chat API with the token-budgeted context, streaming the reply as it arrives
+            context = self.assemble_context()
+            assistant_response = self.generate_response(context)
+
+            # Regenerate with an anti-repetition instruction if the reply repeats recent ones
+            regenerations = 0
+            while True:
+                with metrics.span("repetition") as repetition_span:
+                    check_start = time.perf_counter()
+                    similarity = self.repetition_score(assistant_response)
+                    check_time = time.perf_counter() - check_start
+                    repetition_span["similarity"] = similarity
+                self.response_timings[-1].update({"similarity": similarity, "repetition_check": check_time})
+                if self.echo:
+                    print(Fore.CYAN + f"(Repetition check: similarity {similarity:.2f}, took {check_time * 1000:.2f}ms)" + Style.RESET_ALL)
+                if similarity < REPETITION_THRESHOLD or regenerations >= REPETITION_RETRIES:
+                    break
+                regenerations += 1
+                print(Fore.YELLOW + f"Reply repeats an earlier one (similarity {similarity:.2f}). Discarding it and regenerating..." + Style.RESET_ALL)
+                if self.reply_speech:
+                    self.reply_speech.cancel()  # Its sentences started playing while it streamed
+                assistant_response = self.generate_response(
+                    context + [{"role": "system", "content": ANTI_REPETITION_INSTRUCTION}], " (Regenerated)"
+                )
+        except Exception:
+            # Leave the history as it was before the turn so the user can simply send it again
+            del self.messages[turn_start:]
+            raise
+
+        # Find any matching keywords for the assistant's response (preemptively influence subsequent messages)
+        # matching_keywords_assistant = self.persona.find_matching_keywords(assistant_response)
+
+        # Append new keywords from assistant's response without splitting multi-word phrases
+        # self.append_new_keywords(matching_keywords_assistant)
+
+        # Append the assistant's response to the message history
+        self.messages.append({"role": "assistant", "content": assistant_response})
+
+        # Save the updated history after each interaction
+        with metrics.span("save_history"):
+            self.save_history()
+        return assistant_response
+
+ARCHIVE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    name TEXT NOT NULL,
+    stamp TEXT NOT NULL,            -- Size and modification time of its files when last indexed
+    indexed INTEGER NOT NULL,       -- Number of messages indexed, new ones are appended from here
+    last_digest TEXT NOT NULL       -- Digest of the last indexed message, to notice truncations
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    conversation INTEGER NOT NULL,
+    turn INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_by_turn ON messages(conversation, turn);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(content, content='messages', content_rowid='id', tokenize='porter unicode61');
+CREATE TRIGGER IF NOT EXISTS messages_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_delete AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+END;
+"""
+
+def message_digest(message):
+    """Short digest of a message, stored to tell whether a history was rewritten."""
+    return hashlib.blake2b(json.dumps(message, sort_keys=True).encode('utf-8'), digest_size=16).hexdigest()
+
+class ConversationArchive:
+    """SQLite FTS5 index over the user and assistant messages of every current and backed-up conversation."""
+
+    def __init__(self, path=archive_file):
+        self.path = path
+
+    def connect(self):
+        connection = sqlite3.connect(self.path)
+        connection.executescript(ARCHIVE_SCHEMA)
+        return connection
+
+    def conversation_files(self):
+        """Yield (history file, journal file or None) of every conversation on disk."""
+        for history_file in glob.glob("*_history.json") + glob.glob(os.path.join(sessions_dir, "*_history.json")):
+            yield history_file, history_file[:-len(".json")] + ".journal.jsonl"
+        for backup_file in glob.glob(os.path.join(history_dir, "*.json")):
+            yield backup_file, None
+
+    def read_messages(self, history_file, journal_file):
+        """Read a snapshot or backup and replay its journal, without repairing anything."""
+        try:
+            with open(history_file, 'r') as f:
+                snapshot = json.load(f)
+        except (json.JSONDecodeError, OSError):
+            return []
+        if isinstance(snapshot, list):  # Backups and histories written by older versions
+            return snapshot
+        messages = snapshot.get("messages", [])
+        if journal_file:
+            records, _ = read_journal(journal_file, snapshot.get("generation"))
+            if records:
+                replay_journal(messages, records)
+        return messages
+
+    def sync(self):
+        """Index the messages added to any conversation since the last sync, and return how many were added.
+
+        Conversations whose files were deleted are dropped from the index.
+        """
+        added = 0
+        seen = set()
+        with contextlib.closing(self.connect()) as connection, connection:
+            known = {path: (conversation_id, stamp, indexed, last_digest) for conversation_id, path, stamp, indexed, last_digest
+                     in connection.execute("SELECT id, path, stamp, indexed, last_digest FROM conversations")}
+            for history_file, journal_file in self.conversation_files():
+                path = os.path.abspath(history_file)
+                seen.add(path)
+                stamp = []
+                for file in (history_file, journal_file):
+                    try:
+                        stat = os.stat(file) if file else None
+                    except FileNotFoundError:
+                        stat = None
+                    stamp.append([stat.st_mtime_ns, stat.st_size] if stat else None)
+                stamp = json.dumps(stamp)
+                conversation_id, old_stamp, indexed, last_digest = known.get(path, (None, None, 0, ""))
+                if stamp == old_stamp:
+                    continue
+
+                messages = self.read_messages(history_file, journal_file)
+                if conversation_id is None:
+                    name = os.path.basename(history_file)[:-len(".json")]
+                    conversation_id = connection.execute(
+                        "INSERT INTO conversations (path, name, stamp, indexed, last_digest) VALUES (?, ?, '', 0, '')", (path, name)
+                    ).lastrowid
+                elif indexed > len(messages) or (indexed and message_digest(messages[indexed - 1]) != last_digest):
+                    # Retried, reset or rewritten since the last sync, index it again from the start
+                    connection.execute("DELETE FROM messages WHERE conversation = ?", (conversation_id,))
+                    indexed = 0
+
+                rows = [(conversation_id, turn, msg.get("role", ""), msg.get("content") or "")
+                        for turn, msg in enumerate(messages[indexed:], indexed) if msg.get("role") in ("user", "assistant")]
+                connection.executemany("INSERT INTO messages (conversation, turn, role, content) VALUES (?, ?, ?, ?)", rows)
+                added += len(rows)
+                connection.execute(
+                    "UPDATE conversations SET stamp = ?, indexed = ?, last_digest = ? WHERE id = ?",
+                    (stamp, len(messages), message_digest(messages[-1]) if messages else "", conversation_id),
+                )
+
+            for path in known.keys() - seen:
+                conversation_id = known[path][0]
+                connection.execute("DELETE FROM messages WHERE conversation = ?", (conversation_id,))
+                connection.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
+        return added
+
+    def search(self, query, limit=ARCHIVE_SEARCH_RESULTS):
+        """Return the best matching messages as (conversation, turn, role, snippet), best first."""
+        words = WORD_PATTERN.findall(query)
+        if not words:
+            return []
+        # Quote every word so punctuation in the query is never read as FTS5 syntax
+        match = " ".join('"' + word + '"' for word in words)
+        with contextlib.closing(self.connect()) as connection:
+            return connection.execute(
+                """SELECT conversations.name, messages.turn, messages.role, snippet(messages_fts, 0, '[', ']', '...', 16)
+                   FROM messages_fts
+                   JOIN messages ON messages.id = messages_fts.rowid
+                   JOIN conversations ON conversations.id = messages.conversation
+                   WHERE messages_fts MATCH ?
+                   ORDER BY bm25(messages_fts)
+                   LIMIT ?""",
+                (match, limit),
+            ).fetchall()
+
+def search_archive(query):
+    """Bring the archive up to date and print the messages matching the query."""
+    archive = ConversationArchive()
+    try:
+        start = time.perf_counter()
+        added = archive.sync()
+        results = archive.search(query)
+    except sqlite3.Error as e:
+        print(Fore.RED + f"Archive search failed: {e}" + Style.RESET_ALL)
+        return
+    if not results:
+        print(Fore.YELLOW + f"No archived messages match '{query}'." + Style.RESET_ALL)
+    for name, turn, role, snippet in results:
+        print(Fore.GREEN + f"{name}, turn {turn} ({role}):" + Style.RESET_ALL + f" {snippet}")
+    print(Fore.CYAN + f"(Indexed {added} new messages, searched in {time.perf_counter() - start:.2f}s)" + Style.RESET_ALL)
 
-# Directly print the response instead of streaming in chunks
+# Directly print the response when streaming is turned off
 def display_response(response_text):
     """Directly display the assistant's response without streaming."""
     print(response_text)
 
+# Settings for the xtts-api-server used when TTS is enabled
+TTS_URL = "http://127.0.0.1:8020/tts_stream"
+TTS_SPEAKER = "calm_female"  # Use 'calm_female', 'female', or 'male'
+TTS_WORKERS = 3              # Sentences synthesized at the same time
+MIN_SENTENCE_CHARS = 20      # Shorter sentences are joined with the next one, e.g. after "Mr."
+
+# A sentence ends at . ! ? or … (plus closing quotes, brackets or asterisks) followed by whitespace
+SENTENCE_END = re.compile(r"""[.!?…]+["'”’)\]*]*\s+""")
+
+# Synthesized sentences waiting to be played, in the order they were spoken, with the pipeline that queued them
+speech_queue = queue.Queue()
+tts_executor = None
+tts_lock = threading.Lock()
+
 def play_audio(output_path):
     """Play audio asynchronously with MPC-HC64."""
     player_path = r"C:\Path\To\Player.exe"
     subprocess.run([player_path, output_path], check=True)
 
-# Add a global toggle for TTS
-tts_enabled = False
+def play_audio_data(audio_data):
+    """Play wav audio from memory, falling back to a temporary file for the external player."""
+    if sys.platform == "win32":
+        import winsound
+        winsound.PlaySound(audio_data, winsound.SND_MEMORY)
+        return
 
-def generate_speech(text):
-    """Generate and stream speech using the xtts-api-server, then play it asynchronously."""
-    if not tts_enabled:
-        return  # Exit if TTS is disabled
-        
+    with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as audio_file:
+        audio_file.write(audio_data)
+    try:
+        play_audio(audio_file.name)
+    finally:
+        os.remove(audio_file.name)
+
+def synthesize_speech(text):
+    """Synthesize one sentence with the xtts-api-server and return the wav audio, or None on failure."""
+    with metrics.span("tts_synthesis", chars=len(text)):
+        return request_speech(text)
+
+def request_speech(text):
     try:
         # Define parameters for the request to the TTS server
         tts_params = {
             "text": text,
-            "speaker_wav": "calm_female",  # Use 'calm_female', 'female', or 'male'
+            "speaker_wav": TTS_SPEAKER,
             "language": "en"
         }
 
         # Make a request to the TTS server running on port 8020
-        response = requests.get(
-            "http://127.0.0.1:8020/tts_stream",
+        with get_http_session().get(
+            TTS_URL,
             params=tts_params,
             stream=True,
             proxies={"http": None, "https": None}  # No proxy for local requests
-        )
-
-        # Check if the request was successful
-        if response.status_code == 200:
-            # Define the output path for the audio file
-            output_path = "F:\\AI\\LLM\\SillyTavern-Launcher\\output\\out.wav"
+        ) as response:
+            # Check if the request was successful
+            if response.status_code == 200:
+                # Keep the audio in memory instead of a shared output file
+                return b"".join(chunk for chunk in response.iter_content(chunk_size=512) if chunk)
 
-            # Save the audio response to a file
-            with open(output_path, "wb") as audio_file:
-                for chunk in response.iter_content(chunk_size=512):
-                    if chunk:
-                        audio_file.write(chunk)
-            
-            # Play the audio file in a separate thread
-            threading.Thread(target=play_audio, args=(output_path,), daemon=True).start()
-
-        else:
             print(f"Error: Received status code {response.status_code} from TTS server.")
     except Exception as e:
         print(f"Error generating speech: {e}. Speech synthesis will be skipped.")
+    return None
 
-def auto_send_recap(messages):
-    """Automatically send a recap message if the user types 'recap'."""
-    recap_message = "(OOC: Pause Roleplay and lets recap the events. Before we resume i just want to check up on you so you are on the right track in the roleplay. Can you answer these questions for me: 1. What is the plot? 2. What is the setting? 3. What are our goals? 4. What is your role and my role? 5. What is the current situation? Feel free to use OOC at any point if you have any questions.)"
-    messages.append({"role": "user", "content": recap_message})
-    save_history(messages)
-    
-# Load the Keyword files specified in the configuration
-def load_keywords(keys_files):
-    global keywords
-    for keys_file in keys_files:
+def speech_player():
+    """Play synthesized sentences one after another, waiting for each one to be ready."""
+    while True:
+        speech, audio_future = speech_queue.get()
         try:
-            print(f"Loading keywords file: {keys_file}")
-            with open(keys_file, "r") as file:
-                for line in file:
-                    line = line.strip()
-                    if not line or line.startswith("#"):  # Ignore empty lines or comments
-                        continue
-                    parts = line.split(";")
-                    if len(parts) != 3:
-                        print(f"Warning: Invalid format in line '{line}'. Skipping.")
-                        continue
-                    title, key_string, content = parts
-                    # Strip special characters and newlines from keys
-                    key_string = key_string.replace('', '').replace('', '')
-                    keys = [k.strip() for k in key_string.split(",")]
-                    keywords[title] = {
-                        "key": keys,
-                        "content": content.strip()
-                    }
-        except FileNotFoundError:
-            print(f"Warning: Keys file '{keys_file}' not found. Skipping.")
+            audio_data = audio_future.result()
+        except CancelledError:
+            continue
+        if speech.cancelled:
+            continue  # Its reply was discarded while the sentence was synthesized
+        if audio_data:
+            try:
+                play_audio_data(audio_data)
+            except Exception as e:
+                print(f"Error playing speech: {e}.")
+
+def start_speech_pipeline():
+    """Start the synthesis workers and the player thread the first time speech is needed."""
+    global tts_executor
+    with tts_lock:
+        if tts_executor is None:
+            tts_executor = ThreadPoolExecutor(max_workers=TTS_WORKERS, thread_name_prefix="tts")
+            threading.Thread(target=speech_player, daemon=True).start()
+    return tts_executor
+
+class SpeechPipeline:
+    """Splits a reply into sentences as it arrives and queues their synthesis for ordered playback."""
+
+    def __init__(self):
+        self.executor = start_speech_pipeline()
+        self.buffer = ""
+        self.futures = []
+        self.cancelled = False
+
+    def feed(self, text):
+        """Add streamed text and send every sentence completed by it to synthesis."""
+        self.buffer += text
+        sentence_start = 0
+        for match in SENTENCE_END.finditer(self.buffer):
+            if match.end() - sentence_start >= MIN_SENTENCE_CHARS:
+                self.speak(self.buffer[sentence_start:match.end()])
+                sentence_start = match.end()
+        self.buffer = self.buffer[sentence_start:]
+
+    def finish(self):
+        """Send whatever is left after the reply is complete."""
+        self.speak(self.buffer)
+        self.buffer = ""
+
+    def speak(self, sentence):
+        sentence = sentence.strip()
+        if sentence and not self.cancelled:
+            audio_future = self.executor.submit(synthesize_speech, sentence)
+            self.futures.append(audio_future)
+            speech_queue.put((self, audio_future))
+
+    def cancel(self):
+        """Drop the sentences that are not played yet. The one already playing is finished."""
+        self.cancelled = True
+        self.buffer = ""
+        for audio_future in self.futures:
+            audio_future.cancel()
 
-# Load the filtered keywords from the specified keys files if any are specified
-if keys_files:  # Only attempt to load keywords if keys_files is not empty
-    load_keywords(keys_files)
+def generate_speech(text):
+    """Speak a whole reply through the sentence pipeline, playing it asynchronously."""
+    speech = SpeechPipeline()
+    speech.feed(text)
+    speech.finish()
+
+# Server mode: one process hosting concurrent chat sessions for every persona over HTTP
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8080
+SERVER_WORKERS = 64  # Threads running blocking chat calls, i.e. how many turns can be in flight at once
+
+# Session ids and persona names end up in file names, so only allow plain characters
+SAFE_NAME = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+# (persona name, session id) -> ChatSession, and the lock serializing each session's turns
+chat_sessions = {}
+chat_session_locks = {}
+
+async def get_chat_session(persona_name, session_id):
+    """Return the session and its lock, loading the persona and history the first time."""
+    key = (persona_name, session_id)
+    lock = chat_session_locks.setdefault(key, asyncio.Lock())
+    async with lock:
+        if key not in chat_sessions:
+            persona = await asyncio.to_thread(get_persona, persona_name)
+            chat_sessions[key] = await asyncio.to_thread(ChatSession, persona, session_id, False)
+    return chat_sessions[key], lock
+
+async def route_request(method, path, body):
+    """Handle one API request and return the HTTP status and JSON payload."""
+    if method == "GET" and path == "/personas":
+        return "200 OK", {"personas": list_personas()}
+    if method == "GET" and path == "/stats":
+        return "200 OK", {"stages": metrics.stats(), "hedging": dict(co.hedge_stats) if co is not None else None}
+    if method != "POST" or path not in ("/chat", "/reset"):
+        return "404 Not Found", {"error": f"Unknown endpoint {method} {path}"}
 
-# Print the final loaded keywords for debugging purposes
-print(Fore.CYAN + f"Loaded keywords: {keywords}" + Style.RESET_ALL)
+    try:
+        data = json.loads(body or b"{}")
+    except json.JSONDecodeError:
+        return "400 Bad Request", {"error": "Body must be JSON"}
+    persona_name = str(data.get("persona", ""))
+    session_id = str(data.get("session", "default"))
+    if not SAFE_NAME.match(persona_name) or not SAFE_NAME.match(session_id):
+        return "400 Bad Request", {"error": "persona and session may only contain letters, digits, '_' and '-'"}
+    if not os.path.exists(f"{persona_name}_system.txt"):
+        return "404 Not Found", {"error": f"No system file for persona '{persona_name}'"}
+
+    session, lock = await get_chat_session(persona_name, session_id)
+    async with lock:  # One turn at a time per session, so histories never interleave
+        if path == "/reset":
+            await asyncio.to_thread(session.reset)
+            return "200 OK", {"status": "reset"}
+
+        user_input = str(data.get("message", "")).strip()
+        if not user_input:
+            return "400 Bad Request", {"error": "message is empty"}
+        try:
+            assistant_response = await asyncio.to_thread(session.chat_turn, user_input)
+        except Exception as e:
+            return "502 Bad Gateway", {"error": f"Chat request failed: {e}"}
+        return "200 OK", {"reply": assistant_response, **session.response_timings[-1]}
 
-# Update find_matching_keywords function to reflect the new structure
-# This function will collect matching keywords from the input text
-def find_matching_keywords(input_text):
-    global keywords  # Use the global 'keywords' variable
-    matching_keywords = []
-    input_text_lower = input_text.lower()  # Lowercase the input for case-insensitive comparison
+async def handle_client(reader, writer):
+    """Read one HTTP request, route it and write the JSON response."""
+    try:
+        request_line = (await reader.readline()).decode('latin-1')
+        method, path, _ = request_line.split(' ', 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get('content-length', 0)))
+        status, payload = await route_request(method, path.split('?', 1)[0], body)
+    except (ValueError, asyncio.IncompleteReadError):
+        status, payload = "400 Bad Request", {"error": "Malformed HTTP request"}
+    except Exception as e:
+        status, payload = "500 Internal Server Error", {"error": str(e)}
 
-    for keyword_key, keyword_data in keywords.items():
-        # Check if any of the keywords are present in the input (case-insensitive)
-        keyword_keys = keyword_data.get('key', [])
-        if any(kw.lower() in input_text_lower for kw in keyword_keys):
-            matching_keywords.append(keyword_data)
+    response_body = json.dumps(payload).encode('utf-8')
+    writer.write(
+        f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(response_body)}\r\nConnection: close\r\n\r\n".encode('latin-1')
+        + response_body
+    )
+    try:
+        await writer.drain()
+    finally:
+        writer.close()
+
+async def serve(host, port):
+    """Serve every persona from this process until interrupted."""
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=SERVER_WORKERS))
+
+    # Parse every persona up front so the first chat with each one does not pay for it
+    for persona_name in list_personas():
+        await asyncio.to_thread(get_persona, persona_name)
+
+    start_persona_watcher()
+    server = await asyncio.start_server(handle_client, host, port)
+    print(Fore.GREEN + f"Serving {', '.join(personas) or 'no personas'} on http://{host}:{port} (POST /chat, POST /reset, GET /personas)" + Style.RESET_ALL)
+    async with server:
+        await server.serve_forever()
+
+# Replay mode: scripted conversations run without the console, to regression-test personas and lore
+REPLAY_CONCURRENCY = 8  # Conversations in flight at once
+replays_dir = os.path.join(os.getcwd(), "replays")
+
+def load_script(path):
+    """Read the user turns of a replay script: one {"message": ...} object or JSON string per line."""
+    turns = []
+    with open(path, 'r') as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):  # Ignore empty lines or comments
+                continue
+            turn = json.loads(line)
+            message = turn if isinstance(turn, str) else turn.get("message") if isinstance(turn, dict) else None
+            if not isinstance(message, str) or not message.strip():
+                raise ValueError(f"{path}:{line_number}: expected a JSON string or an object with a \"message\"")
+            turns.append(message.strip())
+    return turns
+
+def replay_session_ids(script_paths):
+    """Give every script a session id that is unique even when scripts in different folders share a name."""
+    session_ids = {}
+    for number, path in enumerate(script_paths, 1):
+        name = re.sub(r"[^A-Za-z0-9_-]+", "_", os.path.splitext(os.path.relpath(path))[0]).strip("_")
+        session_ids[path] = f"{number:03d}_{name[-48:]}"
+    return session_ids
+
+def replay_script(persona_name, script_path, session_id, turns, output_dir):
+    """Run one script through a fresh session with the persona, writing a transcript, and return its timings."""
+    session = ChatSession(get_persona(persona_name), session_id, echo=False, directory=output_dir)
+    transcript_file = os.path.join(output_dir, f"{session.file_prefix}_transcript.jsonl")
+
+    turn_times = []
+    errors = 0
+    with open(transcript_file, 'w') as transcript:
+        for turn_number, message in enumerate(turns, 1):
+            start_time = time.perf_counter()
+            record = {"turn": turn_number, "user": message}
+            try:
+                record["reply"] = session.chat_turn(message)
+                record.update(session.response_timings[-1])
+            except Exception as e:
+                record["error"] = str(e)
+                errors += 1
+            record["seconds"] = time.perf_counter() - start_time
+            turn_times.append(record["seconds"])
+            transcript.write(json.dumps(record) + "\n")
+            transcript.flush()
+
+    turn_times.sort()
+    return {
+        "persona": persona_name,
+        "script": script_path,
+        "transcript": transcript_file,
+        "turns": len(turns),
+        "errors": errors,
+        "seconds": sum(turn_times),
+        "p50_turn_seconds": turn_times[len(turn_times) // 2] if turn_times else None,
+        "max_turn_seconds": turn_times[-1] if turn_times else None,
+    }
+
+def run_replay(script_paths, persona_names, concurrency, output_dir):
+    """Replay every script against every persona, concurrency conversations at a time."""
+    scripts = {}
+    for path in script_paths:
+        try:
+            scripts[path] = load_script(path)
+        except (OSError, ValueError) as e:  # json.JSONDecodeError is a ValueError
+            print(Fore.RED + f"Error: Could not read replay script '{path}': {e}")
+            sys.exit(1)
+    # Sessions resume the histories they find, so a used directory would not replay fresh conversations
+    if glob.glob(os.path.join(glob.escape(output_dir), "*_history*")) or glob.glob(os.path.join(glob.escape(output_dir), "*_transcript.jsonl")):
+        print(Fore.RED + f"Error: '{output_dir}' already holds replayed conversations, choose another --output.")
+        sys.exit(1)
+    os.makedirs(output_dir, exist_ok=True)
+    session_ids = replay_session_ids(scripts)
+
+    started = time.strftime("%Y-%m-%dT%H:%M:%S")
+    start_time = time.perf_counter()
+    runs = []
+    print(f"Replaying {len(scripts)} scripts against {', '.join(persona_names)} ({concurrency} at a time) into {output_dir}")
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="replay") as executor:
+        futures = {
+            executor.submit(replay_script, persona_name, path, session_ids[path], turns, output_dir): (persona_name, path)
+            for persona_name in persona_names for path, turns in scripts.items()
+        }
+        for future in as_completed(futures):
+            persona_name, path = futures[future]
+            try:
+                run = future.result()
+            except Exception as e:
+                print(Fore.RED + f"{persona_name} / {path}: failed: {e}" + Style.RESET_ALL)
+                runs.append({"persona": persona_name, "script": path, "failed": str(e)})
+                continue
+            runs.append(run)
+            color = Fore.YELLOW if run["errors"] else Fore.GREEN
+            print(color + f"{persona_name} / {path}: {run['turns']} turns, {run['errors']} errors, {run['seconds']:.1f}s" + Style.RESET_ALL)
+
+    summary = {
+        "started": started,
+        "seconds": time.perf_counter() - start_time,
+        "concurrency": concurrency,
+        "runs": runs,
+        "stages": metrics.stats(),
+    }
+    summary_file = os.path.join(output_dir, "summary.json")
+    replace_file(summary_file, json.dumps(summary, indent=2))
+    print(Fore.CYAN + f"Replayed {len(runs)} conversations in {summary['seconds']:.1f}s, summary in {summary_file}" + Style.RESET_ALL)
+
+def parse_replay_args(args):
+    """Split the arguments after --replay into scripts, personas, concurrency and output directory."""
+    script_paths = []
+    persona_names = None
+    concurrency = REPLAY_CONCURRENCY
+    output_dir = os.path.join(replays_dir, time.strftime("%Y%m%d-%H%M%S"))
+    position = 0
+    while position < len(args):
+        arg = args[position]
+        if arg in ("--personas", "--concurrency", "--output") and position + 1 < len(args):
+            value = args[position + 1]
+            if arg == "--personas":
+                persona_names = [name.strip() for name in value.split(",") if name.strip()]
+            elif arg == "--concurrency":
+                concurrency = max(1, int(value))
+            else:
+                output_dir = value
+            position += 2
+            continue
+        # The Windows shell does not expand wildcards
+        script_paths.extend(sorted(glob.glob(arg)) or [arg])
+        position += 1
+    return script_paths, persona_names or list_personas(), concurrency, output_dir
 
-    return matching_keywords
+def run_chat(assistant_name):
+    """Interactive chat with one bot in the console."""
+    try:
+        persona = get_persona(assistant_name)
+    except FileNotFoundError:
+        print(Fore.RED + f"Error: System message file '{assistant_name}_system.txt' not found.")
+        sys.exit(1)
 
+    session = ChatSession(persona)
+    start_persona_watcher()
 
-def append_new_keywords(messages, matching_keywords):
-    global pending_keywords
+    # Repeat the last message (if any) after history is loaded
+    session.repeat_last_message()
 
-    if not matching_keywords and not pending_keywords:
-        # print(Fore.YELLOW + "No new or pending keywords to process." + Style.RESET_ALL)
-        return
+    startup_seconds = time.perf_counter() - startup_time
+    if startup_seconds > STARTUP_TARGET_SECONDS:
+        print(Fore.YELLOW + f"Ready in {startup_seconds:.2f}s, slower than the {STARTUP_TARGET_SECONDS:.1f}s target." + Style.RESET_ALL)
+    else:
+        print(Fore.CYAN + f"Ready in {startup_seconds:.2f}s." + Style.RESET_ALL)
 
-    # Add new keywords to pending list if available
-    if matching_keywords:
-        # Extract and clean keywords properly
-        new_keywords = set()
-        for keyword in matching_keywords:
-            keyword_label = keyword['key'][0].strip().lower() if 'key' in keyword and len(keyword['key']) > 0 else ''
-            if keyword_label not in pending_keywords:
-                new_keywords.add(keyword_label)
-
-        # Add the new keywords to the pending list
-        pending_keywords.extend(new_keywords)
-        # print(Fore.GREEN + f"New keywords added to pending list: {new_keywords}" + Style.RESET_ALL)
-
-    # If there are still no pending keywords, exit
-    if not pending_keywords:
-        # print(Fore.YELLOW + "No pending keywords after update." + Style.RESET_ALL)
-        return
+    print(f"\n──────────────────────────────────────────\nWelcome to the {assistant_name} Chat! Type 'exit' to quit, 'recap' for an OOC Summary, 'reset' to start a new conversation, 'tts' to toggle tts (server needs to be running and info set in the TTS settings), 'stream' to toggle token streaming, 'stats' for timings of each stage, 'search: <words>' to search all conversations, 'retry: <instruction>' to retry the last response with (optional) additional instructions or 'swipe' to switch between the retried candidates.\n\nExample start mess to get the bot on track:\n\n{persona.ai_greeting}\n\n")
 
-    # Only send the first keyword from the pending list
-    keyword_to_send = pending_keywords.pop(0)
-    print(Fore.GREEN + f"Processing keyword: {keyword_to_send}" + Style.RESET_ALL)
+    # Main loop for chat
+    while True:
+        # Get input from the user
+        user_input = input(Fore.CYAN + "\n- You:\n" + Style.RESET_ALL)
 
-    # Search for the keyword in the JSON structure
-    keyword_content = None
-    for keyword_key, entry in keywords.items():
-        if keyword_to_send.lower() == keyword_key.lower() or keyword_to_send.lower() in [kw.lower() for kw in entry.get('key', [])]:
-            keyword_content = entry.get('content', None)
-            break
+        # Sanitize input to handle unexpected or special characters
+        user_input = user_input.strip()
 
-    # Proceed only if content is found
-    if keyword_content:
-        # Concatenate the keyword and its content into a concise message
-        concatenated_new_keywords = f"!!AI_IGNORE_FORMAT!!\nReference Material:\n - {keyword_to_send}\n{keyword_content}"
+        # Ignore empty input
+        if not user_input:
+            print(Fore.YELLOW + "Input is empty. Please type a message.")
+            continue
 
-        # Wrap the message in square brackets
-        concatenated_new_keywords = f"[{concatenated_new_keywords}]"
+        # Exit if the user types 'exit'
+        if user_input.lower() == 'exit':
+            print("Goodbye!")
+            break
 
-        # Add it as a 'system' message to provide context without influencing behavior
-        messages.append({"role": "system", "content": concatenated_new_keywords})
-        # print(Fore.CYAN + f"Added new reference material to context:\n{concatenated_new_keywords}" + Style.RESET_ALL)
-    else:
-        print(Fore.RED + f"No content found for keyword: '{keyword_to_send}'. Skipping." + Style.RESET_ALL)
-
-
-# Load the conversation history first
-messages = load_history()
-
-# Repeat the last message (if any) after history is loaded
-repeat_last_message(messages)
-
-print(f"\n──────────────────────────────────────────\nWelcome to the {assistant_name} Chat! Type 'exit' to quit, 'recap' for an OOC Summary, 'reset' to start a new conversation, 'tts' to toggle tts (server needs to be running and info set in def generate_speech) or 'retry: <instruction>' to retry the last response with (optional) additional instructions.\n\nExample start mess to get the bot on track:\n\n{ai_greeting}\n\n")
-
-# Main loop for chat
-while True:
-    # Get input from the user
-    user_input = input(Fore.CYAN + "\n- You:\n" + Style.RESET_ALL)
-
-    # Sanitize input to handle unexpected or special characters
-    user_input = user_input.strip()
-
-    # Ignore empty input
-    if not user_input:
-        print(Fore.YELLOW + "Input is empty. Please type a message.")
-        continue
-
-    # Exit if the user types 'exit'
-    if user_input.lower() == 'exit':
-        print("Goodbye!")
-        break
-        
-    # Command to toggle TTS
-    if user_input.lower() == 'tts':
-        tts_enabled = not tts_enabled
-        print(f"TTS generation {'enabled' if tts_enabled else 'disabled'}.")
-        continue
-
-    # Reset the conversation
-    if user_input.lower() == 'reset':
-        confirm_reset = input(Fore.YELLOW + "Are you sure you want to reset the conversation? (yes/no): " + Style.RESET_ALL).strip().lower()
-        if confirm_reset == 'yes':
-            backup_history()  # Backup the current history
-            messages = [{"role": "system", "content": system_message}]
-            save_history(messages)
-            print(Fore.YELLOW + "Conversation reset.")
+        # Search every current and archived conversation
+        if user_input.lower().startswith('search:'):
+            query = user_input.split(':', 1)[1].strip()
+            if query:
+                search_archive(query)
+            else:
+                print(Fore.YELLOW + "Search query is empty. Use 'search: <words>'.")
             continue
-        else:
-            print(Fore.YELLOW + "Reset cancelled.")
+
+        # Show where turns spend their time
+        if user_input.lower() == 'stats':
+            print(Fore.CYAN + metrics.format_stats() + Style.RESET_ALL)
+            if co is not None:
+                print(Fore.CYAN + co.format_hedge_stats() + Style.RESET_ALL)
             continue
-            
-    # Trigger recap if the user types 'recap'
-    if user_input.lower() == 'recap':
-        auto_send_recap(messages)
-        continue
 
-    # Retry the last response if the user types 'retry'
-    if user_input.lower().startswith('retry'):
-        # Extract additional instructions if provided
-        if ':' in user_input:
-            additional_instruction = user_input.split(':', 1)[1].strip()
-            retry_last_response(messages, additional_instruction)
-        else:
-            retry_last_response(messages)
-        continue
+        # Command to toggle token streaming
+        if user_input.lower() == 'stream':
+            session.stream_enabled = not session.stream_enabled
+            print(f"Token streaming {'enabled' if session.stream_enabled else 'disabled'}.")
+            continue
 
-    # Find any matching entries for user input
-    matching_keywords = find_matching_keywords(user_input)
+        # Command to toggle TTS
+        if user_input.lower() == 'tts':
+            session.tts_enabled = not session.tts_enabled
+            print(f"TTS generation {'enabled' if session.tts_enabled else 'disabled'}.")
+            continue
 
-    # Append new keywords without splitting multi-word phrases
-    append_new_keywords(messages, matching_keywords)
+        # Reset the conversation
+        if user_input.lower() == 'reset':
+            confirm_reset = input(Fore.YELLOW + "Are you sure you want to reset the conversation? (yes/no): " + Style.RESET_ALL).strip().lower()
+            if confirm_reset == 'yes':
+                session.reset()  # Backup the current history and start over
+                print(Fore.YELLOW + "Conversation reset.")
+                continue
+            else:
+                print(Fore.YELLOW + "Reset cancelled.")
+                continue
 
-    # Append the user's message (with context) to the message history
-    messages.append({"role": "user", "content": user_input})
+        # Trigger recap if the user types 'recap'
+        if user_input.lower() == 'recap':
+            session.auto_send_recap()
+            continue
 
-    # Limit the conversation history to the last 100 messages
-    MAX_HISTORY_LENGTH = 100  # Keep the last 100 messages
-    if len(messages) > MAX_HISTORY_LENGTH:
-        messages = messages[-MAX_HISTORY_LENGTH:]
+        # Show the next retry candidate, or a given one with 'swipe: <number>'
+        if user_input.lower().startswith('swipe'):
+            if ':' in user_input:
+                try:
+                    session.swipe(int(user_input.split(':', 1)[1]))
+                except ValueError:
+                    print(Fore.YELLOW + "Use 'swipe' or 'swipe: <number>'.")
+            else:
+                session.swipe()
+            continue
 
-    # Call the Cohere chat API with the message history
-    response = co.chat(
-        **params,  # Use the appropriate model and parameters 
-        messages=messages
-    )
-    
-    # Extract the assistant's response
-    assistant_response = response.message.content[0].text
+        # Retry the last response if the user types 'retry'
+        if user_input.lower().startswith('retry'):
+            # Extract additional instructions if provided
+            if ':' in user_input:
+                additional_instruction = user_input.split(':', 1)[1].strip()
+                session.retry_last_response(additional_instruction)
+            else:
+                session.retry_last_response()
+            continue
 
-    # Find any matching keywords for the assistant's response (preemptively influence subsequent messages)
-    # matching_keywords_assistant = find_matching_keywords(assistant_response)
+        # Keyword injection, chat call (speaking sentences as they arrive when TTS is on) and history saving
+        try:
+            session.chat_turn(user_input)
+        except Exception as e:
+            print(Fore.RED + f"\nError: The chat request failed after retrying: {e}. Your message was not kept, send it again." + Style.RESET_ALL)
 
-    # Append new keywords from assistant's response without splitting multi-word phrases
-    # append_new_keywords(messages, matching_keywords_assistant)
+def main():
+    # --skip-ip-check can go anywhere on the command line
+    args = [arg for arg in sys.argv[1:] if arg != "--skip-ip-check"]
+    ip_check = len(args) == len(sys.argv) - 1
 
-    # Display assistant's response
-    print(Fore.GREEN + f"\n- {assistant_name}:\n" + Style.RESET_ALL, end='')
-    display_response(assistant_response)
+    # Ensure a bot name argument is provided
+    if not args:
+        print(Fore.RED + "Error: Please provide the bot name as a command-line argument, --serve [port] for server mode or --replay <script.jsonl>... for replay mode.")
+        sys.exit(1)
 
-    # Append the assistant's response to the message history
-    messages.append({"role": "assistant", "content": assistant_response})
+    if args[0] == "--serve":
+        # Check the proxy before accepting any chats
+        if ip_check and not check_ip():
+            sys.exit(1)
+        skip_ip_check()
+        port = int(args[1]) if len(args) > 1 else SERVER_PORT
+        asyncio.run(serve(SERVER_HOST, port))
+    elif args[0] == "--replay":
+        try:
+            script_paths, persona_names, concurrency, output_dir = parse_replay_args(args[1:])
+        except ValueError:
+            print(Fore.RED + "Error: --concurrency needs a number.")
+            sys.exit(1)
+        if not script_paths or not persona_names:
+            print(Fore.RED + "Error: Usage: --replay <script.jsonl>... [--personas Name1,Name2] [--concurrency N] [--output dir]")
+            sys.exit(1)
+        if ip_check and not check_ip():
+            sys.exit(1)
+        skip_ip_check()
+        run_replay(script_paths, persona_names, concurrency, output_dir)
+    else:
+        # Check the proxy and import cohere while the bot loads and the user types
+        if ip_check:
+            threading.Thread(target=run_ip_check, daemon=True).start()
+        else:
+            skip_ip_check()
+        preload_client_modules()
 
-    # Limit the conversation history to the last 100 messages
-    MAX_HISTORY_LENGTH = 100  # Keep the last 100 messages
-    if len(messages) > MAX_HISTORY_LENGTH:
-        messages = messages[-MAX_HISTORY_LENGTH:]
-    
-    # Save the updated history after each interaction
-    save_history(messages)
+        # Get the bot name from the command-line argument
+        run_chat(args[0])
 
-    # Generate speech from the assistant's response
-    generate_speech(assistant_response)
+if __name__ == "__main__":
+    main()
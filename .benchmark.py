@@ -0,0 +1,348 @@
+import os
+import sys
+import io
+import json
+import time
+import wave
+import random
+import hashlib
+import argparse
+import platform
+import tempfile
+import threading
+import traceback
+import importlib.util
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+# Benchmarks for the hot paths of .AI-Base.py, run against synthetic lore and histories
+# and a local stub of the Cohere chat API and the xtts /tts_stream endpoint.
+# Results are printed (or written) as JSON so runs of different versions can be compared.
+
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".AI-Base.py")
+
+# Words used for synthetic lore, messages and stub replies
+VOCABULARY = (
+    "the a she he they walks runs looks smiles whispers quickly slowly forest castle river city tavern "
+    "sword lantern map letter old young quiet loud storm night morning road gate tower market guard "
+    "merchant wizard knight dragon shadow light fire water stone glass silver golden broken hidden"
+).split()
+
+# Stub server settings, changed by the command line
+stub_settings = {
+    "chat_latency": 0.2,   # Seconds before the first token (or the whole reply when not streaming)
+    "token_delay": 0.01,   # Seconds between streamed tokens
+    "reply_words": 120,    # Words per reply
+    "tts_latency": 0.1,    # Seconds per /tts_stream request
+}
+
+def synthetic_text(rng, words):
+    return " ".join(rng.choice(VOCABULARY) for _ in range(words))
+
+def silent_wav(seconds=0.5, rate=22050):
+    """A short silent wav file, returned by the stub /tts_stream endpoint."""
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(rate)
+        wav_file.writeframes(b"\0\0" * int(seconds * rate))
+    return buffer.getvalue()
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers POST /v2/chat like the Cohere v2 API (streamed or not) and GET /tts_stream like xtts-api-server."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass  # Keep benchmark output clean
+
+    def send_body(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if urlparse(self.path).path != "/tts_stream":
+            self.send_body(404, "application/json", b'{"message": "not found"}')
+            return
+        time.sleep(stub_settings["tts_latency"])
+        self.send_body(200, "audio/wav", silent_wav())
+
+    def do_POST(self):
+        if urlparse(self.path).path != "/v2/chat":
+            self.send_body(404, "application/json", b'{"message": "not found"}')
+            return
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        rng = random.Random(len(request.get("messages", [])))
+        words = synthetic_text(rng, stub_settings["reply_words"]).split()
+        input_tokens = sum(len(str(message.get("content", ""))) // 4 for message in request.get("messages", []))
+        usage = {"tokens": {"input_tokens": input_tokens, "output_tokens": len(words)}}
+        time.sleep(stub_settings["chat_latency"])
+
+        if not request.get("stream"):
+            body = {
+                "id": "stub",
+                "finish_reason": "COMPLETE",
+                "message": {"role": "assistant", "content": [{"type": "text", "text": " ".join(words) + "."}]},
+                "usage": usage,
+            }
+            self.send_body(200, "application/json", json.dumps(body).encode("utf-8"))
+            return
+
+        # Server-sent events, one per token, closed by message-end
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        events = [{"type": "message-start", "id": "stub", "delta": {"message": {"role": "assistant", "content": []}}},
+                  {"type": "content-start", "index": 0, "delta": {"message": {"content": {"type": "text", "text": ""}}}}]
+        events += [{"type": "content-delta", "index": 0, "delta": {"message": {"content": {"text": word + " "}}}} for word in words]
+        events += [{"type": "content-end", "index": 0},
+                   {"type": "message-end", "id": "stub", "delta": {"finish_reason": "COMPLETE", "usage": usage}}]
+        for event in events:
+            self.wfile.write(f"event: {event['type']}\ndata: {json.dumps(event)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+            if event["type"] == "content-delta":
+                time.sleep(stub_settings["token_delay"])
+        self.close_connection = True
+
+def start_stub_server(port=0):
+    """Start the stub server in a background thread and return it, port 0 picks a free port."""
+    server = ThreadingHTTPServer(("127.0.0.1", port), StubHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def load_chatbot():
+    """Import .AI-Base.py as a module, without starting a chat."""
+    spec = importlib.util.spec_from_file_location("ai_base", SCRIPT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.skip_ip_check()
+    return module
+
+def summarize(samples, operations=None):
+    """Percentiles in milliseconds and throughput for a list of durations in seconds."""
+    ordered = sorted(samples)
+
+    def percentile(fraction):
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000
+
+    total = sum(ordered)
+    return {
+        "runs": len(ordered),
+        "mean_ms": total / len(ordered) * 1000,
+        "min_ms": ordered[0] * 1000,
+        "p50_ms": percentile(0.50),
+        "p90_ms": percentile(0.90),
+        "p99_ms": percentile(0.99),
+        "max_ms": ordered[-1] * 1000,
+        "ops_per_second": (operations or len(ordered)) / total if total else None,
+    }
+
+def timed(function, runs):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+def write_persona(rng, entries):
+    """Write a synthetic persona with one lore file of title;keys;content lines, and return the keys used."""
+    keys = []
+    with open("lore.txt", "w") as lore_file:
+        for index in range(entries):
+            entry_keys = [f"{rng.choice(VOCABULARY)}{index}", f"place{index}", f"{rng.choice(VOCABULARY)} {rng.choice(VOCABULARY)} {index}"]
+            keys.append(entry_keys[0])
+            lore_file.write(f"Entry {index};{','.join(entry_keys)};{synthetic_text(rng, 60)}\n")
+    with open("Bench_system.txt", "w") as system_file:
+        system_file.write("You are Bench, a narrator for a fantasy roleplay.\n\nai_greeting:\nHello.\n\nkeys_files:\nlore.txt\n")
+    return keys
+
+def run_section(results, name, function):
+    """Run one benchmark section and add its results, or record why it failed so the other sections still run."""
+    try:
+        results.update(function())
+    except Exception as e:
+        traceback.print_exc()
+        results[name] = {"failed": f"{type(e).__name__}: {e}"}
+
+def run_benchmarks(args, chatbot, stub_url):
+    rng = random.Random(args.seed)
+    results = {}
+
+    # Persona parsing and keyword index build, uncached and cached. Every other section needs the persona
+    lore_keys = write_persona(rng, args.entries)
+    try:
+        start = time.perf_counter()
+        persona = chatbot.Persona("Bench")
+        results["persona_load_uncached"] = summarize([time.perf_counter() - start])
+        results["persona_load_cached"] = summarize(timed(lambda: chatbot.Persona("Bench"), 3))
+    except Exception as e:
+        traceback.print_exc()
+        results["persona_load"] = {"failed": f"{type(e).__name__}: {e}"}
+        return results
+
+    # Keyword matching on messages where about a third mention lore
+    messages = []
+    for _ in range(args.runs):
+        words = synthetic_text(rng, 40).split()
+        if rng.random() < 0.3:
+            words.insert(rng.randrange(len(words)), rng.choice(lore_keys))
+        messages.append(" ".join(words))
+
+    def keyword_matching():
+        message_iter = iter(messages * 2)
+        return {"find_matching_keywords": summarize(timed(lambda: persona.find_matching_keywords(next(message_iter)), args.runs))}
+
+    # Ranked lore retrieval on the same messages
+    def lore_ranking():
+        message_iter = iter(messages * 2)
+        return {"find_relevant_keywords": summarize(timed(lambda: persona.find_relevant_keywords(next(message_iter)), args.runs))}
+
+    # Keyword injection into a session
+    def keyword_injection():
+        session = chatbot.ChatSession(persona, "keywords", echo=False)
+        matches = [persona.find_matching_keywords(f"tell me about {rng.choice(lore_keys)}") for _ in range(args.runs)]
+        match_iter = iter(matches)
+        return {"append_new_keywords": summarize(timed(lambda: session.append_new_keywords(next(match_iter)), args.runs))}
+
+    # History saving and loading with a long conversation
+    def history():
+        session = chatbot.ChatSession(persona, "history", echo=False)
+        for index in range(args.history):
+            session.messages.append({"role": "user" if index % 2 == 0 else "assistant", "content": synthetic_text(rng, 50)})
+        session.save_history()
+
+        def save_turn():
+            session.messages.append({"role": "user", "content": synthetic_text(rng, 20)})
+            session.messages.append({"role": "assistant", "content": synthetic_text(rng, 80)})
+            session.save_history()
+
+        return {
+            "save_history": summarize(timed(save_turn, args.runs)),
+            "load_history": summarize(timed(session.load_history, max(3, args.runs // 50))),
+        }
+
+    # Full turns and TTS against the stub server, which need cohere and requests
+    chatbot.API_BASE_URL = stub_url
+    chatbot.api_keys = ["stub"]  # The stub takes any key, and real keys from the environment are not sent to it
+    chatbot.TTS_URL = stub_url + "/tts_stream"
+
+    def chat_turns():
+        if importlib.util.find_spec("cohere") is None:
+            return {"chat_turn": {"skipped": "cohere is not installed"}}
+        session = chatbot.ChatSession(persona, "turns", echo=False)
+        for index in range(args.history):
+            session.messages.append({"role": "user" if index % 2 == 0 else "assistant", "content": synthetic_text(rng, 50)})
+        session.save_history()
+        turn_samples = []
+        first_token_samples = []
+        for _ in range(args.turns):
+            start = time.perf_counter()
+            session.chat_turn(f"We walk to the {rng.choice(lore_keys)} at night")
+            turn_samples.append(time.perf_counter() - start)
+            first_token_samples.append(session.response_timings[-1]["first_token"])
+        return {
+            "chat_turn": summarize(turn_samples),
+            "chat_turn_first_token": summarize(first_token_samples),
+            # Time spent outside the API call: lore, context assembly, repetition check and saving
+            "chat_turn_overhead": summarize([turn - timing["total"] for turn, timing in zip(turn_samples, session.response_timings[-len(turn_samples):])]),
+        }
+
+    def speech():
+        if importlib.util.find_spec("requests") is None:
+            return {"synthesize_speech": {"skipped": "requests is not installed"}}
+        # synthesize_speech reports errors and returns None, so only requests that returned audio are timed
+        samples = []
+        failures = 0
+        for _ in range(args.turns):
+            sentence = synthetic_text(rng, 12) + "."
+            start = time.perf_counter()
+            audio = chatbot.synthesize_speech(sentence)
+            if audio is None:
+                failures += 1
+            else:
+                samples.append(time.perf_counter() - start)
+        if samples:
+            return {"synthesize_speech": {**summarize(samples), "failures": failures}}
+        return {"synthesize_speech": {"failed": f"all {failures} requests failed, see the errors above"}}
+
+    run_section(results, "find_matching_keywords", keyword_matching)
+    run_section(results, "find_relevant_keywords", lore_ranking)
+    run_section(results, "append_new_keywords", keyword_injection)
+    run_section(results, "history", history)
+    run_section(results, "chat_turn", chat_turns)
+    run_section(results, "synthesize_speech", speech)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the chatbot hot paths against synthetic data and a local stub API.")
+    parser.add_argument("--entries", type=int, default=100000, help="lore entries to generate")
+    parser.add_argument("--history", type=int, default=10000, help="messages in the benchmark histories")
+    parser.add_argument("--runs", type=int, default=500, help="runs of each local benchmark")
+    parser.add_argument("--turns", type=int, default=20, help="full chat turns against the stub")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--chat-latency", type=float, default=stub_settings["chat_latency"])
+    parser.add_argument("--token-delay", type=float, default=stub_settings["token_delay"])
+    parser.add_argument("--reply-words", type=int, default=stub_settings["reply_words"])
+    parser.add_argument("--tts-latency", type=float, default=stub_settings["tts_latency"])
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    parser.add_argument("--stub-only", action="store_true", help="only run the stub server, e.g. set CO_API_URL to it and chat")
+    parser.add_argument("--port", type=int, default=0, help="stub server port, 0 picks a free one")
+    args = parser.parse_args()
+
+    stub_settings.update(chat_latency=args.chat_latency, token_delay=args.token_delay,
+                         reply_words=args.reply_words, tts_latency=args.tts_latency)
+    server = start_stub_server(args.port)
+    stub_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    if args.stub_only:
+        print(f"Stub Cohere API and TTS server on {stub_url} (set CO_API_URL={stub_url}), Ctrl+C to stop.")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            return
+
+    output_path = os.path.abspath(args.output) if args.output else None
+    with open(SCRIPT_PATH, "rb") as script_file:
+        script_hash = hashlib.sha1(script_file.read()).hexdigest()
+
+    # Everything the chatbot writes (cache, histories, sessions) goes to a throwaway directory
+    previous_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as work_dir:
+        os.chdir(work_dir)
+        try:
+            chatbot = load_chatbot()
+            # Log lines from the chatbot go to stderr, so stdout is only the JSON results
+            real_stdout = sys.stdout
+            sys.stdout = sys.stderr
+            try:
+                results = run_benchmarks(args, chatbot, stub_url)
+            finally:
+                sys.stdout = real_stdout
+        finally:
+            os.chdir(previous_dir)
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "script_sha1": script_hash,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {key: value for key, value in vars(args).items() if key not in ("output", "stub_only", "port")},
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if output_path:
+        with open(output_path, "w") as output_file:
+            output_file.write(text + "\n")
+    else:
+        print(text)
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
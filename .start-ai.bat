@@ -64,6 +64,11 @@ REM set COHERE_API_KEY=xxxxxxx
 REM mail: 	xxx, 2024	xxx@xxx.me
 set COHERE_API_KEY=xxxACTIVEAPIKEYxxx
 
+REM Or pool several keys, calls are spread over them and a rate-limited key is rested automatically
+REM set COHERE_API_KEYS=xxxKEY1xxx,xxxKEY2xxx,xxxKEY3xxx
+REM Trial keys allow 20 calls per minute, uncomment to stay under that instead of waiting out 429s
+REM set CHATBOT_KEY_CALLS_PER_MINUTE=20
+
 if "%charname%"=="" (
     echo No AI selected, exiting...
     exit /b 1